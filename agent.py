@@ -0,0 +1,390 @@
+"""
+Agent module for EMP command-line tool.
+
+This module provides an optional local background agent that keeps SSH
+transports to the fleet open between emp invocations. The CLI forwards
+command, attached, detached and tty requests to it over a Unix socket, so
+they skip the SSH handshake. Dropped connections are re-established with
+exponential backoff.
+"""
+
+import contextlib
+import io
+import json
+import logging
+import os
+import select
+import socket
+import subprocess
+import sys
+import threading
+import time
+from threading import Lock
+
+from commands import Interface
+from interactive import interactive_shell
+from utilities import scribe
+
+logger = logging.getLogger(__name__)
+
+SOCKET_DIR = os.getenv('EMP_AGENT', os.path.expanduser('~/.emp/agent.sock'))
+
+# Commands the agent can serve on behalf of the CLI
+FORWARDED = ('command', 'attached', 'detached', 'tty')
+
+
+def _own_thread():
+    '''
+    Whether the current thread belongs to the agent itself (connection
+    upkeep, status and tty requests) rather than to a command request
+    '''
+    return getattr(threading.current_thread(), 'agent_own', False)
+
+
+class RequestOutput:
+    '''
+    Stands in for sys.stdout or sys.stderr of the agent. What the thread
+    serving a request and the threads it starts write goes to the request's
+    client, with the request's verbosity, the agent's own threads keep
+    writing to the agent's output
+    '''
+
+    def __init__(self, default):
+        self.default = default
+        self.stream = None
+        self.level = None
+
+    def _target(self):
+        return self.stream if self.stream is not None and not _own_thread() else self.default
+
+    @property
+    def verbosity(self):
+        return self.level if self._target() is self.stream else None
+
+    def write(self, data):
+        return self._target().write(data)
+
+    def flush(self):
+        self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.default, name)
+
+
+class ConnectionPool:
+    '''
+    Persistent connections to hosts, (re)connected on demand with backoff
+    '''
+
+    KEEPALIVE = 30
+    MIN_BACKOFF = 1
+    MAX_BACKOFF = 60
+
+    def __init__(self, interface):
+        self.interface = interface
+        self.hosts = {}
+        self.backoff = {}
+        self.lock = Lock()
+
+    def _alive(self, hostname):
+        host = self.hosts.get(hostname)
+        if not host or host.get('client') is None:
+            return False
+        transport = host['client'].get_transport()
+        return transport is not None and transport.is_active()
+
+    def get(self, host):
+        '''
+        Returns connected host dicts for the host/group name, connecting the
+        ones not yet (or no longer) connected
+        '''
+        hosts = self.interface.parse_hostname(host)
+        with self.lock:
+            self._connect(hosts)
+            for hostname in hosts:
+                # Whether a host is only a jump host depends on the selection
+                self.hosts[hostname]['jump'] = hosts[hostname].get('jump', False)
+            return {hostname: self.hosts[hostname] for hostname in hosts}
+
+    def _connect(self, hosts):
+        '''
+        Connects the given hosts in parallel, reusing live connections and
+        skipping hosts still in backoff after a failed attempt
+        '''
+        lock = Lock()
+        threads = []
+        attempted = []
+        now = time.monotonic()
+
+        for hostname, host in hosts.items():
+            host['event'] = threading.Event()
+            if self._alive(hostname):
+                host['client'] = self.hosts[hostname]['client']
+                host['sftp'] = self.hosts[hostname].get('sftp')
+                host['event'].set()
+            elif self.backoff.get(hostname, (0, 0))[0] > now:
+                host['client'] = None
+                host['sftp'] = None
+                host['event'].set()
+
+        for hostname, host in hosts.items():
+            if not host['event'].is_set():
+                attempted.append(hostname)
+                thread = threading.Thread(
+                    target=self.interface.connect_host,
+                    args=(hostname, hosts, lock)
+                )
+                thread.agent_own = _own_thread()
+                threads.append(thread)
+                thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        for hostname in attempted:
+            host = hosts[hostname]
+            if host.get('client') is not None:
+                host['client'].get_transport().set_keepalive(self.KEEPALIVE)
+                self.backoff.pop(hostname, None)
+            else:
+                _, delay = self.backoff.get(hostname, (0, self.MIN_BACKOFF / 2))
+                delay = min(delay * 2, self.MAX_BACKOFF)
+                self.backoff[hostname] = (time.monotonic() + delay, delay)
+                scribe(f"Unavailable, retrying in {delay}s", hostname=hostname)
+
+        for hostname, host in hosts.items():
+            self.hosts[hostname] = host
+
+    def maintain(self, interval=KEEPALIVE):
+        '''
+        Periodically reconnects pooled hosts whose connection dropped
+        '''
+        while True:
+            time.sleep(interval)
+            with self.lock:
+                dropped = {
+                    hostname: dict(host) for hostname, host in self.hosts.items()
+                    if not self._alive(hostname)
+                }
+                if dropped:
+                    # Masters of dropped hosts, up the whole chain, are needed
+                    # for nested connections
+                    for hostname in list(dropped):
+                        master = dropped[hostname].get('master_callsign')
+                        while master and master not in dropped and master in self.hosts:
+                            dropped[master] = dict(self.hosts[master])
+                            master = dropped[master].get('master_callsign')
+                    self._connect(dropped)
+
+
+class Agent:
+    '''
+    Serves CLI requests over a Unix socket using pooled connections
+    '''
+
+    def __init__(self, socket_dir=SOCKET_DIR, **interface_kwargs):
+        self.socket_dir = socket_dir
+        self.interface_kwargs = interface_kwargs
+        self.pool = ConnectionPool(Interface(connect=False, **interface_kwargs))
+        # Requests share the agent's output, so they are served one at a time
+        self.request_lock = Lock()
+        self.outputs = ()
+
+    def serve(self):
+        os.makedirs(os.path.dirname(self.socket_dir), exist_ok=True)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.socket_dir)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_dir)
+        os.chmod(self.socket_dir, 0o600)
+        server.listen()
+        self.outputs = (RequestOutput(sys.stdout), RequestOutput(sys.stderr))
+        sys.stdout, sys.stderr = self.outputs
+        maintainer = threading.Thread(target=self.pool.maintain, daemon=True)
+        maintainer.agent_own = True
+        maintainer.start()
+        scribe(f"Agent listening on {self.socket_dir}", color='green')
+
+        try:
+            while True:
+                conn, _ = server.accept()
+                # Command requests hand their thread over in _run
+                handler = threading.Thread(target=self.handle, args=(conn,), daemon=True)
+                handler.agent_own = True
+                handler.start()
+        finally:
+            server.close()
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.socket_dir)
+
+    def handle(self, conn):
+        try:
+            with conn:
+                request = json.loads(_read_line(conn))
+                if request['command'] == 'status':
+                    self._status(conn)
+                elif request['command'] == 'stop':
+                    conn.sendall(b'Agent stopped\n')
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(self.socket_dir)
+                    os._exit(0)
+                elif request['command'] == 'tty':
+                    self._tty(conn, request)
+                else:
+                    with self.request_lock:
+                        self._run(conn, request)
+        except Exception as e:
+            logger.error(f"Agent request failed: {e}")
+        finally:
+            # Makefile objects keep the socket open, make sure the client sees EOF
+            with contextlib.suppress(OSError):
+                conn.shutdown(socket.SHUT_RDWR)
+
+    def _status(self, conn):
+        with self.pool.lock:
+            lines = [
+                f"{hostname}: {'connected' if self.pool._alive(hostname) else 'disconnected'}"
+                for hostname in sorted(self.pool.hosts)
+            ]
+        conn.sendall(('\n'.join(lines) + '\n').encode())
+
+    def _run(self, conn, request):
+        '''
+        Runs a command/attached/detached request in the client's working
+        directory, streaming its output back
+        '''
+        # This thread and the ones it starts write to the client
+        threading.current_thread().agent_own = False
+        stream = io.TextIOWrapper(conn.makefile('wb'), write_through=True)
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(logging.Formatter('[%(asctime)s.%(msecs)03d] %(levelname)s: %(message)s', '%H:%M:%S'))
+        handler.addFilter(lambda record: not _own_thread())
+        logging.getLogger().addHandler(handler)
+        for output in self.outputs:
+            output.stream, output.level = stream, int(request.get('V', '0'))
+        try:
+            interface = Interface(
+                connections=self.pool.get(request['host']), connect=False, cwd=request['cwd'],
+                **self.interface_kwargs
+            )
+            command = request['command']
+            if command == 'command':
+                interface.command_exec(request['cmd_text'], request['parallel'], request['timeout'])
+            else:
+                interface.command_module_par(
+                    request['directory'], request['rebuild'], command == 'detached', request.get('report'),
+                    request.get('max_in_flight'), request.get('canary', 0), request.get('abort_ratio')
+                )
+        finally:
+            for output in self.outputs:
+                output.stream = None
+            logging.getLogger().removeHandler(handler)
+            stream.close()
+
+    def _tty(self, conn, request):
+        '''
+        Proxies an interactive shell channel to the client socket
+        '''
+        hostname = request['host']
+        host = self.pool.get(hostname)[hostname]
+        if host.get('client') is None:
+            conn.sendall(f'Host "{hostname}" is unreachable\n'.encode())
+            return
+        chan = host['client'].invoke_shell()
+        try:
+            while True:
+                r, _, _ = select.select([chan, conn], [], [])
+                if chan in r:
+                    data = chan.recv(1024)
+                    if not data:
+                        break
+                    conn.sendall(data)
+                if conn in r:
+                    data = conn.recv(1024)
+                    if not data:
+                        break
+                    chan.send(data)
+        finally:
+            chan.close()
+
+
+def _read_line(conn):
+    '''
+    Reads a request line from a socket without buffering, so that nothing
+    sent after it (e.g. the first keystrokes of a tty) is lost
+    '''
+    line = bytearray()
+    while not line.endswith(b'\n'):
+        data = conn.recv(1)
+        if not data:
+            break
+        line += data
+    return bytes(line)
+
+
+class SocketChannel:
+    '''
+    Makes the agent socket usable by interactive_shell like a paramiko channel
+    '''
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def recv(self, size):
+        return self.sock.recv(size)
+
+    def send(self, data):
+        return self.sock.send(data.encode() if isinstance(data, str) else data)
+
+
+def _connect_agent(socket_dir=SOCKET_DIR):
+    '''
+    Returns a socket connected to the agent, or None if it is not running
+    '''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_dir)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def request(payload, socket_dir=SOCKET_DIR):
+    '''
+    Sends a request to the agent and copies its output to stdout.
+    Returns False if no agent is running
+    '''
+    sock = _connect_agent(socket_dir)
+    if sock is None:
+        return False
+    with sock:
+        sock.sendall((json.dumps(payload) + '\n').encode())
+        if payload['command'] == 'tty':
+            interactive_shell(SocketChannel(sock))
+        else:
+            for data in iter(lambda: sock.recv(65536), b''):
+                sys.stdout.buffer.write(data)
+                sys.stdout.flush()
+    return True
+
+
+def start(argv, socket_dir=SOCKET_DIR):
+    '''
+    Starts the agent in the background, logging to agent.log next to the socket
+    '''
+    if _connect_agent(socket_dir) is not None:
+        print(f"Agent already running on {socket_dir}")
+        return
+    os.makedirs(os.path.dirname(socket_dir), exist_ok=True)
+    log = open(os.path.join(os.path.dirname(socket_dir), 'agent.log'), 'ab')
+    subprocess.Popen([sys.executable] + argv, stdout=log, stderr=log, stdin=subprocess.DEVNULL,
+                     start_new_session=True)
+    print(f"Agent starting on {socket_dir}")
@@ -0,0 +1,266 @@
+"""
+Asyncio execution backend for EMP command-line tool.
+
+This module provides AsyncInterface, an Interface whose fleet operations
+(connect, exec, sync, module runs) are scheduled as asyncio tasks instead of
+one OS thread per host. The blocking paramiko calls run in a single bounded
+executor, so the number of threads is set by the global concurrency limit
+rather than by the size of the fleet. Per-host limits keep a host from being
+hit by several operations at once, and cancelling (e.g. Ctrl-C) closes every
+open channel, which stops the remote commands.
+"""
+
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from commands import Interface, ABORT_BATCH
+from utilities import scribe, stream_channel, timed_command, JsonLinesReport
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncInterface(Interface):
+    '''
+    Interface running its fleet operations on asyncio, with global and
+    per-host concurrency limits
+    '''
+
+    def __init__(self, host='', connections={}, verbose=True, transfer_concurrency=4, verify='trust',
+                 connect=True, jump_limit=10, limit=64, host_limit=1, cwd=None):
+        self.limit = limit
+        self.host_limit = host_limit
+        # Channels of commands in flight, closed on cancellation
+        self.channels = set()
+        self.channels_lock = Lock()
+        super().__init__(host, connections, verbose, transfer_concurrency, verify, connect, jump_limit, cwd)
+
+    def run(self, coro, limit=None):
+        '''
+        Runs a coroutine of this interface to completion, with at most limit
+        (default self.limit) blocking calls at a time. On Ctrl-C the running
+        operations are cancelled and their channels closed
+        '''
+        try:
+            return asyncio.run(self._session(coro, limit or self.limit))
+        except KeyboardInterrupt:
+            scribe("Interrupted, closed all running commands", color='red')
+            raise
+
+    async def _session(self, coro, limit):
+        '''
+        Sets up the executor and limits shared by the operations of a run
+        '''
+        self.executor = ThreadPoolExecutor(max_workers=limit)
+        self.semaphore = asyncio.Semaphore(limit)
+        self.host_semaphores = {}
+        try:
+            return await coro
+        finally:
+            self.close_channels()
+            # Threads still blocked on a closed channel return shortly
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def close_channels(self):
+        with self.channels_lock:
+            channels, self.channels = self.channels, set()
+        for channel in channels:
+            channel.close()
+
+    async def _bounded(self, hostname, func, *args):
+        '''
+        Runs a blocking call for a host in the executor, within the global
+        and the per-host limit
+        '''
+        if hostname not in self.host_semaphores:
+            self.host_semaphores[hostname] = asyncio.Semaphore(self.host_limit)
+        async with self.semaphore, self.host_semaphores[hostname]:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def _supervise(self, coros):
+        '''
+        Runs coroutines as tasks and waits for all of them. If one fails or
+        the wait is cancelled, the remaining tasks are cancelled too
+        '''
+        tasks = [asyncio.ensure_future(coro) for coro in coros]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    def _command_exec_single(self, hostname, command, timeout=None, capture=None, echo=True):
+        '''
+        Exec a single command on a specific node (without a pty, so that
+        stderr stays separate), keeping its channel registered so that it
+        can be closed on cancellation
+        '''
+        client = self.connections[hostname]['client']
+        stdin, stdout, stderr = client.exec_command(timed_command(command, timeout))
+        channel = stdout.channel
+        with self.channels_lock:
+            self.channels.add(channel)
+        try:
+            return stream_channel(channel, hostname=hostname, capture=capture, timeout=timeout, echo=echo)
+        finally:
+            with self.channels_lock:
+                self.channels.discard(channel)
+
+    async def connect(self, hostnames=None):
+        '''
+        Connects the given hosts (default all targets) and their masters
+        concurrently, skipping the ones connected already. Nested hosts are
+        connected once their master is
+        '''
+        hosts = self.connections
+        pending = self._pending_connections(hostnames)
+        lock = Lock()
+        tasks = {}
+
+        async def connect_one(hostname):
+            master = hosts[hostname].get('master_callsign')
+            if master and master in tasks:
+                # Waiting here rather than in connect_host keeps executor
+                # threads free for the masters
+                await tasks[master]
+            await self._bounded(hostname, self.connect_host, hostname, hosts, lock)
+
+        for hostname in pending:
+            tasks[hostname] = asyncio.ensure_future(connect_one(hostname))
+        await self._supervise(tasks.values())
+
+    async def probe(self):
+        '''
+        Reports the tmux jobs of every connected target
+        '''
+        await self._supervise(
+            self._bounded(hostname, self.probe_host, hostname) for hostname in self.reachable()
+        )
+
+    async def exec(self, command, timeout=None):
+        '''
+        Exec a command on every connected node.
+        Returns a dict of hostname and (exit status, duration)
+        '''
+        results = {}
+
+        async def run(hostname):
+            start = time.perf_counter()
+            try:
+                status = await self._bounded(hostname, self._command_exec_single, hostname, command, timeout)
+            except Exception as error:
+                scribe(f"Failed: {error}", hostname=hostname, color='red')
+                status = None
+            results[hostname] = (status, time.perf_counter() - start)
+
+        await self.connect()
+        reachable = self.reachable()
+        for hostname in self.targets():
+            if hostname not in reachable:
+                results[hostname] = (None, 0.0)
+
+        await self._supervise(run(hostname) for hostname in reachable)
+        self._print_exec_summary(results, reachable)
+        return results
+
+    async def sync(self, module):
+        '''
+        Syncs a module to every connected node and records a single commit
+        for the hosts that changed.
+        Returns a dict of hostname and whether the module should be rebuilt
+        '''
+        local, last_commit = self._module_snapshot(module)
+        results = {}
+
+        async def sync_one(hostname):
+            should_rebuild, changed = await self._bounded(
+                hostname, self.command_sync, hostname, module, local.snapshot, last_commit
+            )
+            results[hostname] = should_rebuild
+            return changed
+
+        await self.connect()
+        reachable = self.reachable()
+        changed = await self._supervise(sync_one(hostname) for hostname in reachable)
+        synced = [hostname for hostname, host_changed in zip(reachable, changed) if host_changed]
+        if synced:
+            local.update_commit_image(synced)
+        return results
+
+    async def module(self, module, rebuild, detach, report=None, max_in_flight=None, canary=0, abort_ratio=None):
+        '''
+        Syncs, builds and runs a module on every connected node, attached
+        or in tmux, canaries first and with the limits of command_module_par,
+        reporting each host's result as soon as it is done.
+        Returns a dict of hostname and RunResult
+        '''
+        local, last_commit = self._module_snapshot(module)
+        synced = []
+        results = {}
+        report = JsonLinesReport(report) if report else None
+
+        await self.connect()
+        order = self._deploy_order(local, self.reachable(), canary)
+        canaries, rest = order[:canary], order[canary:]
+        min_finished = min(ABORT_BATCH, len(order))
+
+        async def run(hostname, slots):
+            try:
+                results[hostname] = await self._bounded(
+                    hostname, self._command_module, hostname, module, rebuild, detach,
+                    local.snapshot, last_commit, synced
+                )
+                if report is not None:
+                    report.write(results[hostname].as_dict())
+            finally:
+                slots.release()
+
+        async def start(hostnames, in_flight):
+            tasks = []
+            slots = asyncio.Semaphore(in_flight)
+            try:
+                for hostname in hostnames:
+                    await slots.acquire()
+                    if self._should_abort(results, canaries, abort_ratio, min_finished):
+                        break
+                    tasks.append(asyncio.ensure_future(run(hostname, slots)))
+            finally:
+                await self._supervise(tasks)
+
+        await start(canaries, len(canaries) or 1)
+        await start(rest, self._in_flight(rest, max_in_flight, abort_ratio))
+        if synced:
+            local.update_commit_image(synced)
+
+        self._finish_module_results(results, module, detach, report, skipped=order)
+        return results
+
+    async def module_tmux(self, module):
+        '''
+        Runs an already deployed module in tmux on every connected node
+        '''
+        await self.connect()
+        reachable = self.reachable()
+        await self._supervise(
+            self._bounded(hostname, self.command_module_exec_tmux, hostname, module)
+            for hostname in reachable
+        )
+
+    def command_checkall(self, host, verbose=False):
+        self.connections = self.parse_hostname(host)
+        self.run(self._check())
+
+    async def _check(self):
+        await self.connect()
+        await self.probe()
+
+    def command_exec(self, command, parallel=16, timeout=None):
+        return self.run(self.exec(command, timeout), limit=max(1, parallel))
+
+    def command_module_par(self, module, rebuild, detach, report=None, max_in_flight=None, canary=0,
+                           abort_ratio=None):
+        return self.run(self.module(module, rebuild, detach, report, max_in_flight, canary, abort_ratio))
@@ -1,21 +1,34 @@
 import time
 import json, os
+import shlex
 import re
 import paramiko
 from termcolor import colored
 from scp import SCPClient
 from interactive import interactive_shell
-from utilities import VersionControl, time_str, scribe
+from utilities import VersionControl, time_str, scribe, format_table, stream_channel, timed_command
+from utilities import OutputCapture, StatusCache, PROBE_COMMAND, parse_probe, human_size
+from utilities import RunResult, JsonLinesReport, JOBS_DIR, JOBS_COMMAND, new_job_id, parse_jobs
 import sys
 import threading
 from threading import Lock
 from copy import copy
+from concurrent.futures import ThreadPoolExecutor
 
 # Import logging configuration
+import inventory
 import log_utils
 import logging
 
 logger = logging.getLogger(__name__)
+
+# Results of emp check, reused while fresh
+STATUS_CACHE = os.getenv('EMP_STATUS_CACHE', os.path.expanduser('~/.emp/status.json'))
+
+# With an abort ratio: hosts deployed at a time unless max_in_flight is given,
+# and hosts that have to finish before the ratio applies
+ABORT_BATCH = 10
+
 current_module = sys.modules[__name__]
 
 
@@ -52,34 +65,35 @@ class Interface():
                     raise
 
 
-    def __init__(self, host='', connections={}, verbose=True):
+    def __init__(self, host='', connections={}, verbose=True, transfer_concurrency=4, verify='trust', connect=True,
+                 jump_limit=10, cwd=None):
         '''
-        Initialize parameters, execute init commands
+        Initialize parameters and resolve the hosts, which are connected
+        lazily by the commands that need them.
+        With connect=False the given connections are used as they are.
+        Module directories are relative to cwd (default the working directory)
         '''
         self.connections = connections
         self.verbose = verbose
-        self.command_checkall(host)
+        self.cwd = cwd
+        self.transfer_concurrency = transfer_concurrency
+        self.verify = verify
+        # Maximum number of nested hosts handshaking through a master at once
+        self.jump_limit = jump_limit
+        self.sftp_lock = Lock()
+        if connect:
+            self.connections = self.parse_hostname(host)
 
     def parse_hostname(self, hostname):
-        hosts = json.load(open('/Users/georgetheodoropoulos/Code/emeralds/EMP/hosts.json'))
-
-        if hostname in hosts.keys():
-            if hosts[hostname]['master_callsign']:
-                return {hosts[hostname]['master_callsign']:hosts[hosts[hostname]['master_callsign']], 
-                        hostname:hosts[hostname]}
-            else:
-                return {hostname:hosts[hostname]}
-        else:
-            group = [name for name in hosts.keys() if name.startswith(hostname)]
-            logger.debug(f"[{time_str()}] | Hostname groups starting with {hostname}: {group}")
-            if group:
-                result = {name:hosts[name] for name in group}
-                logger.debug(f"[{time_str()}] | Found host group: {result}")
-                return result
-            else:
-                logger.warning("No matching hosts found")
-                return hosts
-
+        '''
+        Resolves a host selector (see inventory) into a dict of hostname and
+        host entry, including the masters nested hosts connect through
+        '''
+        hosts = inventory.select(hostname)
+        logger.debug(f"[{time_str()}] | Hosts matching {hostname}: {list(hosts)}")
+        if not hosts:
+            logger.warning("No matching hosts found")
+        return hosts
 
     def createSSHClient(self,server, port, user, password, sock=None, timeout=10):
         '''
@@ -91,24 +105,64 @@ class Interface():
         client.connect(server, port, user, password=password, sock=sock, timeout=timeout, key_filename="/Users/georgetheodoropoulos/.ssh/id_rsa.pub")
         return client
     
-    def command_checkall(self, host, verbose=False):
-        """
-        Establish SSH connections to all hosts in parallel, respecting dependencies.
-        """
+    def targets(self):
+        '''
+        Returns the selected hosts, without the jump hosts only used to reach them
+        '''
+        return [hostname for hostname in self.connections if not self.connections[hostname].get('jump')]
+
+    def reachable(self):
+        return [hostname for hostname in self.targets() if self.connections[hostname].get('client')]
 
-        hosts = self.parse_hostname(host)
+    def _pending_connections(self, hostnames=None):
+        '''
+        Returns the given hosts (default all targets) and their masters that
+        have not been connected yet, preparing their connection events
+        '''
+        hosts = self.connections
+        needed = set()
+        for hostname in hostnames if hostnames is not None else self.targets():
+            chain = []
+            while hostname in hosts and hostname not in needed:
+                if hostname in chain:
+                    # Hosts in a master_callsign cycle would wait on each other forever
+                    scribe(f"Unavailable, master chain {chain} loops", hostname=hostname, color='red')
+                    for looped in chain:
+                        hosts[looped]['client'] = None
+                    break
+                chain.append(hostname)
+                hostname = hosts[hostname].get('master_callsign')
+            needed.update(chain)
+
+        pending = [hostname for hostname in hosts if hostname in needed and 'client' not in hosts[hostname]]
+        if pending:
+            scribe(f'Connecting to {pending}')
+
+        # Initialize threading.Event for each host, masters connected by an
+        # earlier call are done already
+        for hostname in hosts:
+            if 'event' not in hosts[hostname]:
+                hosts[hostname]['event'] = threading.Event()
+                if 'client' in hosts[hostname]:
+                    hosts[hostname]['event'].set()
+        return pending
 
-        scribe(f'Connecting to {list(hosts.keys())}')
+    def ensure_connected(self, hostnames=None):
+        """
+        Establish SSH connections to the given hosts (default all targets) and
+        the masters they depend on in parallel. Hosts already connected,
+        or that already failed, are not connected again.
+        """
+        hosts = self.connections
+        pending = self._pending_connections(hostnames)
+        if not pending:
+            return
 
         lock = Lock()
         threads = []
 
-        # Initialize threading.Event for each host
-        for hostname in hosts:
-            hosts[hostname]['event'] = threading.Event()
-
         # Start a thread for each host
-        for hostname in hosts:
+        for hostname in pending:
             thread = threading.Thread(
                 target=self.connect_host,
                 args=(hostname, hosts, lock)
@@ -120,18 +174,20 @@ class Interface():
         for thread in threads:
             thread.join()
 
-        # After all threads are done, set the connections
-        self.connections = hosts
-
-        # scribe connection status if verbose
-        # if verbose:
-        #     for hostname in hosts:
-        #         host = hosts[hostname]
-        #         if host['client'] is None:
-        #             scribe(colored(hostname, 'red'), end=" ")
-        #         else:
-        #             scribe(colored(hostname, 'green'), end=" ")
-        #     scribe()
+    def command_checkall(self, host, verbose=False):
+        """
+        Connect to all hosts in parallel and report their tmux jobs.
+        """
+        self.connections = self.parse_hostname(host)
+        self.ensure_connected()
+        threads = [
+            threading.Thread(target=self.probe_host, args=(hostname,))
+            for hostname in self.reachable()
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
 
     def connect_host(self, hostname, hosts_dict, lock):
         """
@@ -145,25 +201,31 @@ class Interface():
                 scribe("Connecting using nested SSH...", hostname=hostname)
                 master_callsign = host['master_callsign']
                 master_host = hosts_dict[master_callsign]
-                master_event = master_host['event']
 
-                # Wait for master to finish connecting
-                master_event.wait(timeout=15)  # Wait up to 10 seconds
+                # Wait for master to finish connecting, it sets its event
+                # whether it succeeds or not (after its own master, if any)
+                master_host['event'].wait()
 
-                # Check if the master client is available
+                # Check if the master client is available, only the shared
+                # state is read under the lock so children handshake in parallel
                 with lock:
-                    if master_host.get('client') is None:
-                        # Master failed, so this host can't connect
-                        host['client'] = None
-                        host['sftp'] = None
-                        event.set()
-                        return
-                    # Use the master's transport to connect to this host
-                    transport = master_host['client'].get_transport()
+                    master_client = master_host.get('client')
+                    if master_client is not None and 'jump_slots' not in master_host:
+                        master_host['jump_slots'] = threading.BoundedSemaphore(self.jump_limit)
+                    slots = master_host.get('jump_slots')
+                if master_client is None:
+                    # Master failed, so this host can't connect
+                    raise Exception(f"master {master_callsign} is unavailable")
+
+                # Use the master's transport to connect to this host, with at
+                # most jump_limit handshakes in flight through it
+                with slots:
+                    transport = master_client.get_transport()
                     channel = transport.open_channel(
                         "direct-tcpip",
                         (host['ip'], host['port']),
-                        (master_host['ip'], master_host['port'])
+                        (master_host['ip'], master_host['port']),
+                        timeout=10
                     )
 
                     # Create SSH client through the channel
@@ -182,28 +244,10 @@ class Interface():
                     timeout=10
                 )
 
-            # Create SFTP client
-            sftp = self.MySFTPClient.from_transport(client.get_transport())
-            scribe("Checking TMUX...", hostname=hostname)
-            stdin, stdout, stderr = client.exec_command('tmux ls')
-            stderr = stderr.readlines()
-            scribe(f"TMUX stderr: {stderr}", hostname=hostname)
-            if stderr: 
-                if stderr[0].startswith('no server running'):
-                    scribe("Available, Free", hostname=hostname, color='green')
-                elif 'command not found' in stderr[0]:
-                    scribe("Available: tmux not installed", hostname=hostname, color='yellow')
-            else:
-                jobs = [val.split(':')[0] for val in stdout.readlines() if val.startswith('_emp')]
-                if jobs:
-                    scribe(f"Available, Busy running: {jobs}", hostname=hostname, color='yellow')
-                else:
-                    scribe("Available, Free", hostname=hostname, color='green')
-
-            # Save to hosts dictionary (with lock)
+            # Save to hosts dictionary (with lock), SFTP is opened on first use
             with lock:
                 host['client'] = client
-                host['sftp'] = sftp
+                host['sftp'] = None
 
         except Exception as error:
             # Log error or handle it
@@ -217,50 +261,185 @@ class Interface():
             # Signal this host thread is done
             event.set()
 
+    def command_check(self, ttl=30, as_json=False, parallel=16):
+        '''
+        Reports the status of every target: reachability, running emp tmux
+        jobs, load, free memory and disk and the deployed module versions.
+        Hosts checked less than ttl seconds ago are served from the cache
+        without connecting. Prints a table, or JSON if as_json.
+        Returns a dict of hostname and status
+        '''
+        cache = StatusCache(STATUS_CACHE, ttl).load()
+        results = {hostname: cache.get(hostname) for hostname in self.targets()}
+        stale = [hostname for hostname, status in results.items() if status is None]
+
+        if stale:
+            self.ensure_connected(stale)
+
+            def probe(hostname):
+                if not self.connections[hostname].get('client'):
+                    return {'reachable': False}
+                capture = OutputCapture()
+                try:
+                    self._command_exec_single(hostname, PROBE_COMMAND, timeout=30, capture=capture, echo=False)
+                except Exception as error:
+                    logger.debug(f"Probe of {hostname} failed: {error}")
+                    return {'reachable': False}
+                return parse_probe(capture.tail('stdout'))
+
+            with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+                for hostname, status in zip(stale, executor.map(probe, stale)):
+                    # Even when the entry is stale already (ttl <= 0)
+                    results[hostname] = cache.put(hostname, status)
+            try:
+                cache.save()
+            except OSError as e:
+                logger.debug(f"Could not write status cache {STATUS_CACHE}: {e}")
+
+        if as_json:
+            print(json.dumps(results, indent=2))
+            return results
+
+        rows = []
+        for hostname, status in results.items():
+            if not status.get('reachable'):
+                rows.append([hostname, 'unreachable'] + ['-'] * 5)
+                continue
+            rows.append([
+                hostname,
+                'up',
+                ' '.join(f'{load:.2f}' for load in status['load']) if status['load'] else '-',
+                human_size(status['mem_free']),
+                human_size(status['disk_free']),
+                ','.join(status['jobs']) or '-',
+                ','.join(f"{name}@{module['version']}" for name, module in status['modules'].items()) or '-',
+            ])
+        print(format_table(rows, ['HOST', 'STATUS', 'LOAD', 'MEM FREE', 'DISK FREE', 'JOBS', 'MODULES']))
+        return results
+
+    def probe_host(self, hostname):
+        '''
+        Reports whether a connected host is free or running emp tmux jobs
+        '''
+        client = self.connections[hostname]['client']
+        scribe("Checking TMUX...", hostname=hostname)
+        stdin, stdout, stderr = client.exec_command('tmux ls')
+        stderr = stderr.readlines()
+        scribe(f"TMUX stderr: {stderr}", hostname=hostname)
+        if stderr: 
+            if stderr[0].startswith('no server running'):
+                scribe("Available, Free", hostname=hostname, color='green')
+            elif 'command not found' in stderr[0]:
+                scribe("Available: tmux not installed", hostname=hostname, color='yellow')
+        else:
+            jobs = [val.split(':')[0] for val in stdout.readlines() if val.startswith('_emp')]
+            if jobs:
+                scribe(f"Available, Busy running: {jobs}", hostname=hostname, color='yellow')
+            else:
+                scribe("Available, Free", hostname=hostname, color='green')
+
+    def sftp(self, hostname):
+        '''
+        Returns the SFTP client of a connected host, opening it on first use
+        '''
+        host = self.connections[hostname]
+        with self.sftp_lock:
+            if host.get('sftp') is None:
+                host['sftp'] = self.MySFTPClient.from_transport(host['client'].get_transport())
+            return host['sftp']
+
     def command_tty(self, hostname):
         '''
         TTY for host - a terminal window for connecting and running commands. 
         TODO: Not sure if this is the optimal way to do this.
         '''
         try:
+            self.ensure_connected([hostname])
             chan = self.connections[hostname]['client'].invoke_shell()
         except:
             raise Exception(f'Host "{hostname}" is unreachable')
         interactive_shell(chan)
 
-    def command_exec(self, command):
+    def command_exec(self, command, parallel=16, timeout=None):
         '''
-        Exec a single command on a specific node.
+        Exec a command on every connected node concurrently, at most parallel
+        at a time, each killed after timeout seconds. Output is streamed as it
+        arrives, tagged by host, followed by a summary of exit codes and durations.
+        Returns a dict of hostname and (exit status, duration)
         '''
-        for hostname in self.connections:
-            self._command_exec_single(hostname, command)
+        results = {}
+        self.ensure_connected()
+
+        def run(hostname):
+            start = time.perf_counter()
+            try:
+                status = self._command_exec_single(hostname, command, timeout)
+            except Exception as error:
+                scribe(f"Failed: {error}", hostname=hostname, color='red')
+                status = None
+            results[hostname] = (status, time.perf_counter() - start)
 
-    def _command_exec_single(self, hostname, command):
+        reachable = self.reachable()
+        for hostname in self.targets():
+            if hostname not in reachable:
+                results[hostname] = (None, 0.0)
+
+        if reachable:
+            with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+                list(executor.map(run, reachable))
+
+        self._print_exec_summary(results, reachable)
+        return results
+
+    def _print_exec_summary(self, results, reachable):
+        '''
+        Prints the exit code and duration of a command on every host
+        '''
+        rows = []
+        for hostname in self.targets():
+            status, duration = results[hostname]
+            if hostname not in reachable:
+                status_str = 'unreachable'
+            elif status is None:
+                status_str = 'failed'
+            elif status == -1:
+                status_str = 'timeout'
+            else:
+                status_str = str(status)
+            rows.append([hostname, status_str, f'{duration:.2f}s'])
+        print(format_table(rows, ['HOST', 'EXIT', 'DURATION']))
+
+    def _command_exec_single(self, hostname, command, timeout=None, capture=None, echo=True):
         '''
-        Exec a single command on a specific node.
+        Exec a single command on a specific node, streaming stdout and stderr
+        as they arrive (unless echo is False, and into capture, an
+        OutputCapture, if given). There is no pty, so that stderr stays
+        separate from stdout.
+        Returns the exit status, -1 if it was killed after timeout seconds
         '''
         # if verbose: scribe(f'[*] Executing command "{command}" on host {hostname}')
 
-        stdin, stdout, stderr = self.connections[hostname]['client'].exec_command(command, get_pty=True)
-        for line in stdout:
-            scribe(""+line.strip('\n'), hostname=hostname, color='green')
-        for line in stderr:
-            scribe(""+line.strip('\n'), hostname=hostname, color='red')
+        stdin, stdout, stderr = self.connections[hostname]['client'].exec_command(timed_command(command, timeout))
+        return stream_channel(stdout.channel, hostname=hostname, capture=capture, timeout=timeout, echo=echo)
 
 
-    def command_sync(self, hostname, module):
+    def command_sync(self, hostname, module, snapshot=None, last_commit=None):
         '''
         This is used to deploy a module.
         Input:
             hostname - host callsign (alpha, bravo etc.)
             module - module name (directory in modules folder)
-            session - the paramiko session
+            snapshot - local module snapshot shared by all hosts of a deploy
+            last_commit - latest recorded commit shared by all hosts of a deploy
         
         What is done:
             1) Create directories ("modules" and subdir for specific module with name)
             2) Clone local module dir to remote dir with the same name
+            3) Record the new commit, unless the caller records it for all hosts
+
+        Returns whether the module should be rebuilt and whether the target changed
         '''
-        sftp = self.connections[hostname]['sftp']
+        sftp = self.sftp(hostname)
 
         sftp.mkdir('modules', ignore_existing=True)
         sftp.mkdir(f'modules/{module}', ignore_existing=True)
@@ -271,81 +450,327 @@ class Interface():
 
         # Check if any changes have been made to the module
         client.chdir(module)
-        source_dir = os.path.abspath(module)
-        vc = VersionControl(client, source_dir, verbose)
+        source_dir = self._module_dir(module)
+        vc = VersionControl(client, source_dir, self.verbose, snapshot=snapshot, last_commit=last_commit,
+                            hostname=hostname, concurrency=self.transfer_concurrency, verify=self.verify)
         vc.compare_modules()
         vc.update_target()
         should_rebuild = vc.should_rebuild
 
-        return should_rebuild
+        # Shared deploys write the commit image once, after every host is done
+        if snapshot is None and vc.has_changes():
+            vc.update_commit_image([hostname])
+
+        return should_rebuild, vc.has_changes()
 
-    def command_module_deploy(self, hostname, module):
+    def command_module_deploy(self, hostname, module, capture=None):
         '''
         Builds the given module(runs requirements file)
+        Returns the exit status of init.sh, None if the module has none
         '''
-        if 'init.sh' in os.listdir(f'.'):
+        if 'init.sh' in os.listdir(self._module_dir(module)):
             scribe('\n-Found init script..')
-            self.command_exec(hostname, f'cd modules/{module}; bash init.sh')
+            return self._command_exec_single(hostname, f'cd modules/{module}; bash init.sh', capture=capture)
+        return None
 
-    def command_module_exec(self, hostname, module):
+    def command_module_exec(self, hostname, module, capture=None):
         '''
         This runs an already deployed module (i.e. executes the run.sh file that needs to be present in the module dir)
+        Returns the exit status of run.sh
         '''
-        self._command_exec_single(hostname, f'cd modules/{module}; bash run.sh')
+        return self._command_exec_single(hostname, f'cd modules/{module}; bash run.sh', capture=capture)
 
-    def command_module_exec_tmux(self, hostname, module):
+    def command_module_exec_tmux(self, hostname, module, capture=None, job=None):
         '''
         This runs an already deployed module (i.e. executes the run.sh file that needs to be present in the module dir)
+        in a tmux session. Its output and exit status are written to the job's directory under JOBS_DIR
+        Returns the exit status of starting the tmux session
         '''
-        self.command_exec(hostname, f'tmux new-session -d -s _emp_{module}_{int(time.time())} "cd modules/{module}; bash run.sh"')
+        job = job or new_job_id(module)
+        job_dir = f'{JOBS_DIR}/{job}'
+        run = (
+            f'job="$PWD/{job_dir}"; cd modules/{shlex.quote(module)}; '
+            f'bash run.sh > "$job/stdout" 2> "$job/stderr"; echo $? > "$job/exit_status"'
+        )
+        return self._command_exec_single(
+            hostname,
+            f'mkdir -p {job_dir} && echo {shlex.quote(module)} {int(time.time())} > {job_dir}/job && '
+            f'tmux new-session -d -s _emp_{job} {shlex.quote(run)}',
+            capture=capture
+        )
         # pid = int(stdout.readline())
         # scribe("PID", pid)
 
-    def _command_module(self, hostname, module, rebuild, detach):
+    def command_jobs(self, parallel=16, as_json=False):
+        '''
+        Lists the detached jobs of every target concurrently, with their
+        status (exit code, running or lost) and output size.
+        Returns a dict of hostname and list of jobs, None if unreachable
+        '''
+        self.ensure_connected()
+
+        def list_jobs(hostname):
+            capture = OutputCapture(limit=1024 * 1024)
+            try:
+                self._command_exec_single(hostname, JOBS_COMMAND, timeout=30, capture=capture, echo=False)
+            except Exception as error:
+                logger.debug(f"Listing jobs of {hostname} failed: {error}")
+                return None
+            return parse_jobs(capture.tail('stdout'))
+
+        reachable = self.reachable()
+        results = {hostname: None for hostname in self.targets()}
+        with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+            results.update(zip(reachable, executor.map(list_jobs, reachable)))
+
+        if as_json:
+            print(json.dumps(results, indent=2))
+            return results
+
+        rows = []
+        for hostname, jobs in results.items():
+            if jobs is None:
+                rows.append([hostname, '-', '-', '-', 'unreachable', '-'])
+            for job in jobs or []:
+                started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(job['start'])) if job['start'] else '-'
+                rows.append([hostname, job['job'], job['module'] or '-', started, job['status'],
+                             human_size(job['stdout_bytes'])])
+        print(format_table(rows, ['HOST', 'JOB', 'MODULE', 'STARTED', 'STATUS', 'OUTPUT']))
+        return results
+
+    def command_logs(self, hostname, job=None, stream='stdout', follow=False, tail=None, interval=1):
+        '''
+        Prints the stdout (or stderr) of a detached job, by default the
+        latest one of the host. Only the last tail bytes are printed if
+        given, and with follow new output is printed as it is written until
+        the job finishes. Every read fetches only the bytes past the offset
+        already printed
+        '''
+        self.ensure_connected([hostname])
+        if not self.connections[hostname].get('client'):
+            raise Exception(f'Host "{hostname}" is unreachable')
+        sftp = self.sftp(hostname)
+
+        if job is None:
+            capture = OutputCapture(limit=1024 * 1024)
+            self._command_exec_single(hostname, JOBS_COMMAND, timeout=30, capture=capture, echo=False)
+            jobs = parse_jobs(capture.tail('stdout'))
+            if not jobs:
+                scribe("No jobs found", hostname=hostname)
+                return
+            job = jobs[-1]['job']
+
+        log_dir = f'{JOBS_DIR}/{job}/{stream}'
+        offset = 0
+        if tail is not None:
+            offset = max(0, sftp.stat(log_dir).st_size - tail)
+        out = getattr(sys.stdout, 'buffer', None)
+
+        while True:
+            # The exit status is checked before reading, so the last read
+            # after it appears gets all of the output
+            finished = True
+            if follow:
+                try:
+                    sftp.stat(f'{JOBS_DIR}/{job}/exit_status')
+                except IOError:
+                    finished = False
+            with sftp.open(log_dir, 'rb') as f:
+                f.seek(offset)
+                data = f.read()
+            if data:
+                offset += len(data)
+                if out is not None:
+                    out.write(data)
+                else:
+                    sys.stdout.write(data.decode(errors='replace'))
+                sys.stdout.flush()
+            if finished:
+                return
+            time.sleep(interval)
+
+    def _command_module(self, hostname, module, rebuild, detach, snapshot=None, last_commit=None, synced=None):
         '''
         Responsible for syncing, deploying and executing a module.
         If a module already exists, validations or actions are being performed.
         E.g update enviroment/update files
+        Hosts whose module changed are appended to synced
+        Returns a RunResult, a failed build skips the run
         '''
-        # SYNC
-        scribe('\n-Syncing  module..')
-        should_build = self.command_sync(hostname, module)
+        result = RunResult(hostname, module, detach)
+        try:
+            # SYNC
+            scribe('\n-Syncing  module..')
+            should_build, result.changed = self.command_sync(hostname, module, snapshot, last_commit)
+            if result.changed and synced is not None:
+                synced.append(hostname)
+
+            # DEPLOY
+            if should_build or rebuild:
+                result.phase = 'build'
+                scribe('\n-Building  module..')
+                status = self.command_module_deploy(hostname, module, result.capture)
+                result.built = status is not None
+                if status:
+                    return result.finish(status)
+
+            # EXEC
+            result.phase = 'run'
+            if detach:
+                self.probe_host(hostname)
+                scribe(f'\n-Running {module} in detached mode..')
+                result.job = new_job_id(module)
+                status = self.command_module_exec_tmux(hostname, module, result.capture, result.job)
+            else:
+                scribe(f'\n-Running {module} in stdout mode..')
+                status = self.command_module_exec(hostname, module, result.capture)
+            return result.finish(status)
+        except Exception as error:
+            scribe(f"Failed during {result.phase}: {error}", hostname=hostname, color='red')
+            return result.finish(error=str(error))
 
-        # DEPLOY
-        if should_build or rebuild:
-            scribe('\n-Building  module..')
-            self.command_module_deploy(hostname, module)
+    def _module_dir(self, module):
+        '''
+        Returns the absolute path of a local module directory
+        '''
+        return os.path.abspath(os.path.join(self.cwd or os.getcwd(), module))
 
-        # EXEC
-        if detach:
-            scribe(f'\n-Running {module} in detached mode..')
-            self.command_module_exec_tmux(hostname, module)
-        else:
-            scribe(f'\n-Running {module} in stdout mode..')
-            self.command_module_exec(hostname, module)
+    def _module_snapshot(self, module):
+        '''
+        Scans the local module and loads its latest commit once, all hosts of
+        a deploy share them read-only.
+        Returns the local VersionControl (holding the snapshot) and the commit
+        '''
+        local = VersionControl(None, self._module_dir(module), self.verbose)
+        local.snapshot = local.scan()
+        return local, local.load_commit_image()
 
-    def command_module_par(self, module, rebuild, detach):
+    def command_module_par(self, module, rebuild, detach, report=None, max_in_flight=None, canary=0,
+                           abort_ratio=None):
         '''
         Responsible for syncing, deploying and executing a module.
         If a module already exists, validations or actions are being performed.
         E.g update enviroment/update files
+        Hosts are deployed in the order of _deploy_order: the first canary
+        hosts alone first, stopping if any of them fails, then the rest
+        with at most max_in_flight at a time (ABORT_BATCH with an abort_ratio,
+        all of them otherwise). Once ABORT_BATCH hosts have finished, no more
+        hosts are started while the ratio of failed hosts exceeds abort_ratio,
+        the ones not started are reported as skipped.
+        Each host's result is appended to the JSON lines report (if given) as
+        soon as the host is done, followed by a summary table.
+        Returns a dict of hostname and RunResult
         '''
 
-        threads = []
+        synced = []
+        results = {}
+        report = JsonLinesReport(report) if report else None
+        local, last_commit = self._module_snapshot(module)
+        self.ensure_connected()
+        order = self._deploy_order(local, self.reachable(), canary)
+        canaries, rest = order[:canary], order[canary:]
+        min_finished = min(ABORT_BATCH, len(order))
 
-        # Start a thread for each host
-        for hostname in self.connections:
-            thread = threading.Thread(
-                target=self._command_module,
-                args=(hostname, module, rebuild, detach)
-            )
-            threads.append(thread)
-            thread.start()
+        def run(hostname, slots):
+            try:
+                results[hostname] = self._command_module(
+                    hostname, module, rebuild, detach, local.snapshot, last_commit, synced
+                )
+                if report is not None:
+                    report.write(results[hostname].as_dict())
+            finally:
+                slots.release()
+
+        def start(hostnames, in_flight):
+            # A thread for each host, started once one of the slots is free
+            threads = []
+            slots = threading.Semaphore(in_flight)
+            for hostname in hostnames:
+                slots.acquire()
+                if self._should_abort(results, canaries, abort_ratio, min_finished):
+                    break
+                thread = threading.Thread(target=run, args=(hostname, slots))
+                threads.append(thread)
+                thread.start()
+
+            # Wait for all threads to complete
+            for thread in threads:
+                thread.join()
+
+        start(canaries, len(canaries) or 1)
+        start(rest, self._in_flight(rest, max_in_flight, abort_ratio))
+
+        # Record a single commit for every host that was updated
+        if synced:
+            local.update_commit_image(synced)
+
+        self._finish_module_results(results, module, detach, report, skipped=order)
+        return results
+
+    def _deploy_order(self, local, hostnames, canary=0):
+        '''
+        Returns the order hosts are deployed in: canary hosts first (the ones
+        tagged "canary", then in inventory order), then the largest expected
+        uploads first, so the long transfers overlap with the short ones
+        '''
+        tagged = [hostname for hostname in hostnames if 'canary' in (self.connections[hostname].get('tags') or [])]
+        canaries = (tagged + [hostname for hostname in hostnames if hostname not in tagged])[:canary]
+        sizes = {hostname: local.transfer_estimate(hostname) for hostname in hostnames if hostname not in canaries}
+        return canaries + sorted(sizes, key=sizes.get, reverse=True)
+
+    def _in_flight(self, hostnames, max_in_flight, abort_ratio):
+        '''
+        Returns how many of the hosts after the canaries are deployed at a
+        time. An abort_ratio needs batches, with every host started at once
+        none would be left to skip by the time failures come in
+        '''
+        if max_in_flight:
+            return max_in_flight
+        if abort_ratio is not None:
+            return min(ABORT_BATCH, len(hostnames)) or 1
+        return len(hostnames) or 1
+
+    def _should_abort(self, results, canaries, abort_ratio, min_finished=1):
+        '''
+        Whether a deploy should start no more hosts: a canary failed, or at
+        least min_finished hosts finished and more than abort_ratio of them
+        failed
+        '''
+        finished = list(results.values())
+        if any(not results[hostname].ok for hostname in canaries if hostname in results):
+            scribe("Canary failed, aborting deploy", color='red')
+            return True
+        failures = sum(1 for result in finished if not result.ok)
+        if abort_ratio is not None and len(finished) >= max(1, min_finished) and failures / len(finished) > abort_ratio:
+            scribe(f"{failures} of {len(finished)} hosts failed, aborting deploy", color='red')
+            return True
+        return False
+
+    def _finish_module_results(self, results, module, detach, report, skipped=()):
+        '''
+        Adds the skipped and unreachable targets to the results of a module
+        run, reports them and prints a summary of every host
+        '''
+        for hostname in self.targets():
+            if hostname not in results:
+                error = 'skipped' if hostname in skipped else 'unreachable'
+                results[hostname] = RunResult(hostname, module, detach).finish(error=error)
+                if report is not None:
+                    report.write(results[hostname].as_dict())
+
+        rows = []
+        for hostname in self.targets():
+            result = results[hostname].as_dict()
+            if result['error'] is not None:
+                status_str = result['error'] if result['error'] in ('unreachable', 'skipped') else 'failed'
+            else:
+                status_str = str(result['exit_code'])
+            rows.append([
+                hostname, result['phase'], status_str, f"{result['duration']:.2f}s",
+                human_size(result['stdout_bytes'] + result['stderr_bytes'])
+            ])
+        print(format_table(rows, ['HOST', 'PHASE', 'EXIT', 'DURATION', 'OUTPUT']))
 
-        # Wait for all threads to complete
-        for thread in threads:
-            thread.join()
-        
 
     # ssh = createSSHClient(config['alpha']['host'], config['alpha']['port'], config['alpha']['uname'], config['alpha']['pass'])
     # scp = SCPClient(ssh.get_transport())
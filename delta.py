@@ -0,0 +1,145 @@
+"""
+Delta transfer module for EMP command-line tool.
+
+This module implements an rsync-style block delta: the target lists the
+signatures of the fixed size blocks of its copy of a file, the source finds
+those blocks in the new version with a rolling checksum, and only the
+instructions to rebuild the file (block copies plus literal data) are sent
+back, where the file is reconstructed and atomically replaced.
+"""
+
+import hashlib
+import struct
+import numpy as np
+
+# Weak checksum is zlib's adler32, which the target computes natively
+ADLER_MOD = 65521
+
+# Number of window positions checksummed per numpy batch
+SCAN_CHUNK = 1 << 20
+
+# Script executed on the target, argv: file. Prints the block size followed
+# by "<adler32> <md5>" for every full block of the file.
+SIGNATURE_SCRIPT = """
+import hashlib, os, sys, zlib
+name = sys.argv[1]
+size = os.path.getsize(name)
+block = max(2048, min(131072, int(size ** 0.5) // 1024 * 1024))
+lines = [str(block)]
+with open(name, 'rb') as f:
+    while True:
+        data = f.read(block)
+        if len(data) < block:
+            break
+        lines.append('%d %s' % (zlib.adler32(data) & 0xffffffff, hashlib.md5(data).hexdigest()))
+sys.stdout.write('\\n'.join(lines) + '\\n')
+"""
+
+# Script executed on the target, argv: file, md5 of the new file, block size.
+# Reads the delta from stdin, rebuilds the file next to the old one and
+# renames it over the old one only if the result has the expected md5.
+PATCH_SCRIPT = """
+import hashlib, os, struct, sys
+name, expected, block = sys.argv[1], sys.argv[2], int(sys.argv[3])
+stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+head, tail = os.path.split(name)
+tmp = os.path.join(head, '.' + tail + '.emp-delta')
+hash_md5 = hashlib.md5()
+try:
+    with open(name, 'rb') as old:
+        with open(tmp, 'wb') as new:
+            while True:
+                op = stdin.read(1)
+                if not op:
+                    break
+                value = struct.unpack('>Q', stdin.read(8))[0]
+                if op == b'C':
+                    old.seek(value * block)
+                    data = old.read(block)
+                else:
+                    data = stdin.read(value)
+                hash_md5.update(data)
+                new.write(data)
+    if hash_md5.hexdigest() != expected:
+        raise ValueError('checksum mismatch after patching ' + name)
+    os.chmod(tmp, os.stat(name).st_mode & 0o7777)
+    os.rename(tmp, name)
+except Exception as e:
+    try:
+        os.remove(tmp)
+    except OSError:
+        pass
+    sys.stderr.write(str(e) + '\\n')
+    sys.exit(1)
+"""
+
+
+def parse_signatures(output):
+    """
+    Parses the output of SIGNATURE_SCRIPT into the block size and a dict of
+    weak checksum -> {md5: block index}
+    """
+    lines = output.decode().split()
+    block_size = int(lines[0])
+    signatures = {}
+    for index, (weak, strong) in enumerate(zip(lines[1::2], lines[2::2])):
+        # Keep the first block when several blocks have the same content
+        signatures.setdefault(int(weak), {}).setdefault(strong, index)
+    return block_size, signatures
+
+
+def rolling_adler32(data, block_size):
+    """
+    Returns the adler32 of every block_size window of data (a uint8 array),
+    i.e. len(data) - block_size + 1 values
+    """
+    x = data.astype(np.int64)
+    k = np.arange(len(x), dtype=np.int64)
+    s1 = np.concatenate(([0], np.cumsum(x)))
+    s2 = np.concatenate(([0], np.cumsum(k * x)))
+    starts = np.arange(len(x) - block_size + 1, dtype=np.int64)
+    ends = starts + block_size
+    sums = s1[ends] - s1[starts]
+    # sum of (block_size - j) * x[start + j] over the window
+    weighted = (block_size + starts) * sums - (s2[ends] - s2[starts])
+    a = (1 + sums) % ADLER_MOD
+    b = (block_size + weighted) % ADLER_MOD
+    return (b << 16) | a
+
+
+def compute_delta(data, block_size, signatures):
+    """
+    Returns the delta that rebuilds data from the target's blocks, as a
+    stream of b'C' + block index and b'L' + length + literal records
+    """
+    delta = []
+    weaks = np.array(list(signatures), dtype=np.int64)
+    array = np.frombuffer(data, dtype=np.uint8)
+    last = len(data) - block_size
+    pos = literal_start = 0
+
+    def literal(start, end):
+        if end > start:
+            delta.append(b'L' + struct.pack('>Q', end - start) + data[start:end])
+
+    while weaks.size and pos <= last:
+        end = min(last + 1, pos + SCAN_CHUNK)
+        window = rolling_adler32(array[pos:end + block_size - 1], block_size)
+        candidates = np.flatnonzero(np.isin(window, weaks))
+        for offset in candidates:
+            start = pos + int(offset)
+            # Skip windows that overlap the last matched block
+            if start < literal_start:
+                continue
+            block = data[start:start + block_size]
+            strong = signatures[int(window[offset])].get(hashlib.md5(block).hexdigest())
+            if strong is None:
+                continue
+            literal(literal_start, start)
+            delta.append(b'C' + struct.pack('>Q', strong))
+            literal_start = start + block_size
+        pos = max(end, literal_start)
+
+    literal(literal_start, len(data))
+    return b''.join(delta)
+
@@ -0,0 +1,143 @@
+"""
+Host inventory module for EMP command-line tool.
+
+This module loads hosts.json once per process, reloading it only when its
+modification time changes, and indexes it for host selection. Selectors are
+comma separated terms, each of which is one of:
+
+    name        exact host name, or every host name starting with it
+    @tag        every host with the tag in its "tags" list
+    pattern     shell-style glob (contains *, ? or [)
+    !term       excludes the hosts matched by term
+
+The masters (master_callsign) of selected hosts are added transitively, so
+nested hosts can always be connected through their jump hosts; the ones not
+selected themselves are marked with "jump". A selector matching nothing
+selects nothing.
+"""
+
+import bisect
+import fnmatch
+import json
+import logging
+import os
+import re
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+HOSTS_FILE = os.getenv('EMP_HOSTS', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hosts.json'))
+
+GLOB_CHARS = re.compile(r'[*?\[]')
+
+
+class Inventory:
+    '''
+    Indexed view of a hosts file
+    '''
+
+    def __init__(self, hosts):
+        self.hosts = hosts
+        self.position = {name: index for index, name in enumerate(hosts)}
+        # Sorted names, a prefix maps to a contiguous range of them
+        self.names = sorted(hosts)
+        self.tags = {}
+        for name, host in hosts.items():
+            for tag in host.get('tags') or []:
+                self.tags.setdefault(tag, []).append(name)
+
+    def prefixed(self, prefix):
+        '''
+        Returns the host names starting with prefix
+        '''
+        start = bisect.bisect_left(self.names, prefix)
+        end = start
+        while end < len(self.names) and self.names[end].startswith(prefix):
+            end += 1
+        return self.names[start:end]
+
+    def match(self, term):
+        '''
+        Returns the host names matched by a single selector term
+        '''
+        if term.startswith('@'):
+            return self.tags.get(term[1:], [])
+        glob = GLOB_CHARS.search(term)
+        if glob:
+            # Only names sharing the literal part before the wildcard can match
+            return fnmatch.filter(self.prefixed(term[:glob.start()]), term)
+        if term in self.hosts:
+            return [term]
+        return self.prefixed(term)
+
+    def with_masters(self, names):
+        '''
+        Adds the masters of the given hosts, up the whole chain
+        '''
+        selected = set(names)
+        for name in names:
+            master = self.hosts[name].get('master_callsign')
+            while master and master not in selected:
+                if master not in self.hosts:
+                    logger.warning(f"Master {master} of {name} is not in the inventory")
+                    break
+                selected.add(master)
+                master = self.hosts[master].get('master_callsign')
+        return selected
+
+    def select(self, selector):
+        '''
+        Resolves a selector into a dict of hostname and a copy of its entry,
+        in inventory order. An empty selector selects every host
+        '''
+        if not selector:
+            names = set(self.hosts)
+        else:
+            terms = [term.strip() for term in selector.split(',') if term.strip()]
+            # A selector of only exclusions starts from the whole fleet
+            if all(term.startswith('!') for term in terms):
+                included = set(self.hosts)
+            else:
+                included = set()
+            excluded = set()
+            for term in terms:
+                target = excluded if term.startswith('!') else included
+                term = term.lstrip('!')
+                matched = self.match(term)
+                if not matched:
+                    logger.warning(f"No hosts match {term}")
+                target.update(matched)
+            names = self.with_masters(included - excluded)
+
+        logger.debug(f"Selector {selector!r} matched {len(names)} hosts")
+        # Callers attach connection state, so every call gets its own dicts
+        selected = {name: dict(self.hosts[name]) for name in sorted(names, key=self.position.get)}
+        if selector:
+            # Masters only added to reach nested hosts are not targets themselves
+            for name in names - (included - excluded):
+                selected[name]['jump'] = True
+        return selected
+
+
+_cache = {}
+_cache_lock = Lock()
+
+
+def load(path=HOSTS_FILE):
+    '''
+    Returns the Inventory of the hosts file, parsing it again only if it
+    changed since it was last loaded
+    '''
+    path = os.path.abspath(path)
+    mtime = os.stat(path).st_mtime_ns
+    with _cache_lock:
+        cached = _cache.get(path)
+        if cached is None or cached[0] != mtime:
+            with open(path) as f:
+                cached = (mtime, Inventory(json.load(f)))
+            _cache[path] = cached
+        return cached[1]
+
+
+def select(selector, path=HOSTS_FILE):
+    return load(path).select(selector)
@@ -6,12 +6,13 @@ sys.path.append(os.path.dirname(__file__))
 import argparse
 import pandas as pd
 import numpy as np
-from haversine import haversine
-import math
+from haversine import haversine, haversine_vector
 from functools import wraps
 import time
+import heapq
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from datetime import timedelta
-from scipy.interpolate import interp1d
 from sklearn.cluster import OPTICS, DBSCAN
 from scipy.spatial.distance import euclidean, pdist
 from dtw import dtw
@@ -38,24 +39,48 @@ def timeit(func):
 		return result
 	return timeit_wrapper
 
+def calc_outliers(series, alpha = 3):
+	'''
+	Returns a series of indexes of row that are to be concidered outliers, using the quantilies of the data.
+	'''
+	q25, q75 = series.quantile((0.25, 0.75))
+	iqr = q75 - q25
+	q_high = q75 + alpha*iqr
+	q_low = q25 - alpha*iqr
+	# return the indexes of rows that are over/under the threshold above
+	return (series >q_high) | (series<q_low) , q_low, q_high
+
+def to_datetime(series, ts_unit):
+	'''
+	Convert a column of timestamps to (UTC, naive) datetimes. Numbers (int or float) are epochs in
+	ts_unit, strings are parsed in bulk with the format inferred, falling back to dateutil per record
+	when they do not share a format.
+	'''
+	if pd.api.types.is_datetime64_any_dtype(series):
+		return pd.to_datetime(series, utc=True).dt.tz_localize(None)
+	if series.dtype=='O' or pd.api.types.is_string_dtype(series):
+		try:
+			return pd.to_datetime(series, utc=True).dt.tz_localize(None)
+		except (ValueError, TypeError):
+			# Naive timestamps are UTC here too, not local time (as with datetime.timestamp())
+			return pd.to_datetime(series.map(parse), utc=True).dt.tz_localize(None)
+	if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+		return pd.to_datetime(series, unit=ts_unit)
+	raise TypeError(f"dtype '{series.dtype}' is not allowed")
+
 @timeit
 def init_df(df, oid, ts, ts_unit):
 	'''
 	Set oid, ts and rid columns for consistency + sort based on oid and ts
 	'''
-	result = df.sort_values(by=[oid, ts])  
+	ts_series = to_datetime(df[ts], ts_unit)
+	result = df.loc[pd.DataFrame({'oid': df[oid], 'ts': ts_series}).sort_values(by=['oid', 'ts']).index]
 	# print('Creating discrete object ids...')
-	result['oid'] = result[oid].map({v: key for key, v in enumerate(result[oid].unique().tolist())})
-	if result[ts].dtype=='O':
-		ts_series = result[ts].apply(lambda a: parse(a).timestamp())
-	elif result[ts].dtype=='int64':
-		ts_series = result[ts]
-	else:
-		raise TypeError(f"dtype '{result[ts].dtype}' is not allowed")
+	result['oid'] = pd.factorize(result[oid], sort=True)[0]
 	# print('Creating ts column...')
-	result['ts'] = pd.to_datetime(ts_series,unit=ts_unit)
+	result['ts'] = ts_series
 	# print('Creating per object record identifiers...')
-	result['rid'] = [x for l in result.groupby('oid', group_keys=False).apply(lambda a: range(len(a))).tolist() for x in l]
+	result['rid'] = result.groupby('oid').cumcount()
 	return result
 
 @timeit
@@ -64,17 +89,6 @@ def drop_outliers(df, features, alpha):
 	Find outliers on "feature" based on iqr and drop them
 	'''
 
-	def calc_outliers(series, alpha = 3):
-		'''
-		Returns a series of indexes of row that are to be concidered outliers, using the quantilies of the data.
-		'''
-		q25, q75 = series.quantile((0.25, 0.75))
-		iqr = q75 - q25
-		q_high = q75 + alpha*iqr
-		q_low = q25 - alpha*iqr
-		# return the indexes of rows that are over/under the threshold above
-		return (series >q_high) | (series<q_low) , q_low, q_high
-
 	if type(features) != list:
 		features = features.split(',')
 
@@ -91,26 +105,46 @@ def drop_outliers(df, features, alpha):
 def speed_bearing(df):
 	'''
 	Calculate speed and bearing valeus based on coordinates.
+	Works on the whole frame at once (sorted by oid and ts): every record gets the speed/bearing
+	from its previous record, the first record of a trajectory copies the second one and single
+	record trajectories get 0.
 	'''
-
-	def calc(traj):
-		if len(traj)==1: return pd.DataFrame([[0.0, 0.0]], dtype='float')
-		tsdif = traj.ts.diff()[1:]
-		coords = zip(traj[['lat', 'lon']].values, traj[['lat', 'lon']].values[1:], tsdif)
-
-		speeds = []
-		brgs = []
-
-		for a, b, tsd in coords:
-			speeds.append(haversine(a, b, 'nmi')/(tsd.seconds/3600))
-			dLon = (b[1] - a[1])
-			x = math.cos(math.radians(b[0])) * math.sin(math.radians(dLon))
-			y = math.cos(math.radians(a[0])) * math.sin(math.radians(b[0])) - math.sin(math.radians(a[0])) * math.cos(math.radians(b[0])) * math.cos(math.radians(dLon))
-			brgs.append(np.degrees(np.arctan2(x,y)))
-
-		return pd.DataFrame([pd.Series([speeds[0]]+speeds), pd.Series([brgs[0]]+brgs)], dtype='float').transpose()
-		
-	df[['sp', 'br']] = df.groupby('oid', group_keys=False).apply(lambda traj: calc(traj)).reset_index(drop=True)
+	oids = df['oid'].to_numpy()
+	lat = df['lat'].to_numpy(dtype=np.float64)
+	lon = df['lon'].to_numpy(dtype=np.float64)
+	ts = df['ts'].to_numpy().astype('datetime64[ns]').astype(np.int64)
+
+	sp = np.zeros(len(df))
+	br = np.zeros(len(df))
+
+	if len(df) > 1:
+		# same[i] is True when records i and i+1 belong to the same trajectory
+		same = oids[1:] == oids[:-1]
+		# Timedelta.seconds, i.e. whole seconds without the days
+		seconds = ((ts[1:] - ts[:-1]) // 10**9) % 86400
+		a = np.column_stack((lat[:-1], lon[:-1]))
+		b = np.column_stack((lat[1:], lon[1:]))
+		with np.errstate(divide='ignore', invalid='ignore'):
+			speeds = haversine_vector(a, b, 'nmi') / (seconds / 3600)
+
+		lat1, lat2 = np.radians(lat[:-1]), np.radians(lat[1:])
+		dlon = np.radians(lon[1:] - lon[:-1])
+		x = np.cos(lat2) * np.sin(dlon)
+		y = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dlon)
+		brgs = np.degrees(np.arctan2(x, y))
+
+		sp[1:] = np.where(same, speeds, 0.0)
+		br[1:] = np.where(same, brgs, 0.0)
+
+		# The first record of a trajectory copies the value of the second one
+		first = np.flatnonzero(np.concatenate(([True], ~same)))
+		first = first[first < len(df) - 1]
+		first = first[same[first]]
+		sp[first] = sp[first + 1]
+		br[first] = br[first + 1]
+
+	df['sp'] = sp
+	df['br'] = br
 
 	return df
 
@@ -122,104 +156,150 @@ def read_csv(input_path):
 def drop_duplicates(df, columns):
 	return df.drop_duplicates(columns).reset_index(drop=True)
 
+def gap_threshold(df):
+	'''
+	Mean over trajectories of the upper outlier threshold of their sampling interval, in seconds
+	'''
+	oids = df.oid.values
+	ts = df.ts.values.astype('datetime64[ns]').astype(np.int64)
+	same = np.concatenate(([False], oids[1:] == oids[:-1]))
+	diffs = pd.Series(np.where(same, np.diff(ts, prepend=0), np.nan)).groupby(oids)
+	q25, q75 = diffs.quantile(0.25), diffs.quantile(0.75)
+	# Timedelta.seconds of the threshold, i.e. whole seconds without the days
+	return ((q75 + 3*(q75 - q25)) // 10**9 % 86400).mean()
+
+# Number of first intervals of a trajectory its sampling rate is estimated on in streaming mode
+RATE_WINDOW = 32
+
+def sampling_rate(df, window=None):
+	'''
+	Sampling rate of every trajectory of a frame sorted by oid and ts: the median of its intervals (of its
+	first window intervals if given) in whole seconds (Timedelta.seconds), NaN for single record
+	trajectories. Indexed by oid
+	'''
+	oids = df.oid.values
+	ts = df.ts.values.astype('datetime64[ns]').astype(np.int64)
+	same = np.concatenate(([False], oids[1:] == oids[:-1]))
+	first = same if window is None else same & (df.groupby('oid').cumcount().values <= window)
+	diffs = pd.Series(np.diff(ts, prepend=0)[first])
+	return (diffs.groupby(oids[first]).median() // 10**9 % 86400).reindex(pd.unique(oids))
+
+def find_gaps(oids, ts, threshold):
+	'''
+	Positions of the records that follow a gap (an interval longer than threshold seconds) in their
+	trajectory, for oids and ts (int64 nanoseconds) sorted by oid and ts
+	'''
+	limit = pd.Timedelta(timedelta(seconds=threshold)).value
+	return np.flatnonzero((oids[1:] == oids[:-1]) & (np.diff(ts) > limit)) + 1
+
 @timeit
-def resample_gaps(df):
+def resample_gaps(df, threshold=None, rate_window=None, rates=None, lengths=None, first_gap=None):
 	'''
 	Find outlier wrt to sampling rate and used that a threshold to detect gaps in sampling.
-	Then resample these gaps using the median sampling value of the oid trajectory.
+	Then resample these gaps using the median sampling value of the oid trajectory (of its first
+	rate_window intervals if given, see sampling_rate).
+	The threshold is computed from df (see gap_threshold) unless given.
+	All the gaps of all the trajectories (of at least 3 records) are found and interpolated (linearly,
+	numeric columns) at once, on the multiples of the sampling rate inside each gap.
+	When df only holds part of the trajectories, rates, lengths (records of the whole trajectory) and
+	first_gap (id of its first gap in df) can be given per oid.
 	'''
-
-	def calc_outliers(series, alpha = 3):
-		'''
-		Returns a series of indexes of row that are to be concidered outliers, using the quantilies of the data.
-		'''
-		q25, q75 = series.quantile((0.25, 0.75))
-		iqr = q75 - q25
-		q_high = q75 + alpha*iqr
-		q_low = q25 - alpha*iqr
-		# return the indexes of rows that are over/under the threshold above
-		return (series >q_high) | (series<q_low) , q_low, q_high
-
-
-	def temporal_resampling_v2(df, gap_id, temporal_unit='s', rate='60S', method='linear', min_pts=1, speed_col='sp', label=1):
-		# The Interpolate module of SciPy requires at least 2 Records
-		
-		if len(df) < min_pts or df.ts.diff().max().seconds<int(rate.removesuffix('S')):
-			return df.iloc[0:0]
-
-		# Define temp. axis and feature space
-		x = pd.to_datetime(df['ts'], unit=temporal_unit).values.astype(np.int64)
-		y = df.loc[:,(df.dtypes == int) | (df.dtypes== float)].values
-		# Fetch the starting and ending timestamps of the trajectory
-		dt_start = pd.to_datetime(df['ts'].min(), unit=temporal_unit)
-		dt_end = pd.to_datetime(df['ts'].max(), unit=temporal_unit)
-		# Interpolate
-		f = interp1d(x, y, kind=method, axis=0)
-		xnew_V3 = pd.date_range(start=dt_start.round(rate), end=dt_end, freq=rate, inclusive='right')
-
-		# Reconstruct the new (resampled) dataframe
-		df_RESAMPLED = pd.DataFrame(f(xnew_V3), columns=df.columns[(df.dtypes == int) | (df.dtypes== float)])
-		if df_RESAMPLED.empty:
-			return
-		df_RESAMPLED.loc[:, 'ts'] = xnew_V3
-		df_RESAMPLED.loc[:, 'gap_id'] = gap_id
-
-		df_RESAMPLED.loc[:, 'oid'] = getattr(df.iloc[0, :], 'oid')
-		df_RESAMPLED.loc[:, 'sp'] = haversine(df.iloc[0][['lat', 'lon']].values, df.iloc[1][['lat', 'lon']].values, 'nmi')/(df.ts.diff().iloc[-1].seconds/3600)
-		return df_RESAMPLED
-	
-
-	def _resample_gaps(traj, gap_threshold):
-		if len(traj)<3: return traj
-		traj.reset_index(drop=True, inplace=True)
-		median_sr = traj.ts.diff().median().seconds
-		gaps = traj[(traj.ts.diff()>timedelta(seconds=gap_threshold))].index
-		if len(gaps)==0:
-			return traj
-
-		lst = [temporal_resampling_v2(traj.iloc[gap-1:gap+1], ind, rate=f'{median_sr}S') for ind, gap in enumerate(gaps)]
-
-		# print('1', lst)
-		res = pd.concat([traj]+lst).sort_values(by=['oid', 'ts']).reset_index(drop=True)
-		# print(res.head())
-		return res
-
-	gap_threshold = df.groupby('oid').apply(lambda tmp: calc_outliers(tmp.ts.diff())[2].seconds).mean()
-	# for i in range(50):
-	#     tmp = df.loc[df.oid==i].reset_index(drop=True)
-
-	return df.groupby('oid', group_keys=False).apply(lambda traj: _resample_gaps(traj, gap_threshold)).reset_index(drop=True)
+	if threshold is None:
+		threshold = gap_threshold(df)
+	df = df.reset_index(drop=True)
+	if len(df) < 2:
+		return df
+	if rates is None:
+		rates = sampling_rate(df, rate_window)
+
+	oids = df.oid.values
+	ts = df.ts.values.astype('datetime64[ns]').astype(np.int64)
+	starts = np.flatnonzero(np.concatenate(([True], oids[1:] != oids[:-1])))
+	counts = np.diff(np.append(starts, len(df)))
+	traj = np.repeat(np.arange(len(starts)), counts)
+	if lengths is not None:
+		counts = lengths.reindex(oids[starts]).values
+
+	# gaps[i]: first record after the i-th gap
+	gaps = find_gaps(oids, ts, threshold)
+	gaps = gaps[counts[traj[gaps]] >= 3]
+	if len(gaps) == 0:
+		return df
+	gap_traj = traj[gaps]
+	# Numbered per trajectory
+	gap_id = np.arange(len(gaps)) - np.searchsorted(gap_traj, gap_traj)
+	if first_gap is not None:
+		gap_id = gap_id + first_gap.reindex(oids[gaps]).fillna(0).values.astype(np.int64)
+	x0, x1 = ts[gaps-1], ts[gaps]
+	gap_seconds = (x1 - x0) // 10**9 % 86400
+	rate = np.nan_to_num(rates.reindex(oids[gaps]).values.astype(np.float64)).astype(np.int64) * 10**9
+
+	# Resampled timestamps: multiples of the rate after the start of the gap (rounded half to even),
+	# up to its end, for the gaps that are longer than the rate
+	q, rem = np.divmod(x0, np.maximum(rate, 1))
+	first = (q + ((2*rem > rate) | ((2*rem == rate) & (q % 2 == 1)))) * rate
+	points = np.where((rate > 0) & (gap_seconds*10**9 >= rate), (x1 - first) // np.maximum(rate, 1), 0)
+	points = np.maximum(points, 0)
+	if points.sum() == 0:
+		return df
+	index = np.repeat(np.arange(len(gaps)), points)
+	step = np.arange(len(index)) - np.repeat(np.cumsum(points) - points, points) + 1
+	x = first[index] + step*rate[index]
+
+	columns = df.columns[(df.dtypes == int) | (df.dtypes == float)]
+	values = df[columns].values.astype(np.float64)
+	y0, y1 = values[gaps-1][index], values[gaps][index]
+	slope = (y1 - y0) / (x1 - x0)[index][:, None]
+	resampled = pd.DataFrame(slope * (x.astype(np.float64) - x0[index].astype(np.float64))[:, None] + y0, columns=columns)
+	resampled['ts'] = x.astype('datetime64[ns]')
+	resampled['gap_id'] = gap_id[index]
+	resampled['oid'] = oids[gaps][index]
+	# Speed over the whole gap
+	speed = haversine_vector(df[['lat', 'lon']].values[gaps-1], df[['lat', 'lon']].values[gaps], 'nmi') / (gap_seconds/3600)
+	resampled['sp'] = speed[index]
+
+	# Records first on equal (oid, ts)
+	return pd.concat([df, resampled]).sort_values(by=['oid', 'ts'], kind='stable').reset_index(drop=True)
+
+def trip_ids(oids, status, start=None):
+	'''
+	Number the trips (runs of records with status 1) of every trajectory in a frame sorted by oid and ts.
+	Records with status 0 get -1. Trips are numbered from start (per record, the counter of the
+	trajectory before its first record in the frame, 0 by default).
+	Returns the trip ids and the counter after every record
+	'''
+	oids = np.asarray(oids)
+	status = np.asarray(status)
+	first = np.concatenate(([True], oids[1:] != oids[:-1]))
+	# A trip ends on a record with status 0 that follows one with status 1 of the same trajectory
+	ends = np.concatenate(([False], (status[:-1] == 1) & (status[1:] == 0))) & ~first
+	counts = np.cumsum(ends)
+	# Restart the count on the first record of every trajectory
+	counts = counts - np.maximum.accumulate(np.where(first, counts, 0))
+	if start is not None:
+		counts = counts + np.asarray(start)
+	return np.where(status == 1, counts, -1), counts
 
 @timeit
 def trips(df):
 	'''
 	Based on the records where sp<1 (from TRIPS), cluster (DBSCAN) and detect stopages (places where many records with sp<1 are found)
 	'''
-	def apply_trips(traj):
-		used = False
-		t_id = 0
-		tids = []
-		for status in traj.status.tolist():
-			if status == 0:
-				if used:
-					used=False
-					t_id+=1
-				tids.append(-1)
-			else:
-				tids.append(t_id)
-				used=True
-		
-		return tids
-
-	df['status'] = df.sp.apply(lambda sp: 0 if sp<1 else 1)
+	df['status'] = (df.sp >= 1).astype(int)
 
-	df['tid'] = df.groupby('oid').apply(apply_trips).explode().reset_index(drop=True)
+	df['tid'] = trip_ids(df.oid.values, df.status.values)[0]
 
 	return df
 
 @timeit
 def stopages(df):
 	data = df.loc[df.status==0][['lon', 'lat']].sample(frac=0.1).values
+	return cluster_stops(data)
+
+def cluster_stops(data):
+	'''
+	Cluster (lon, lat) points of stopped records and return the center of every cluster
+	'''
 	# clustering = OPTICS(min_samples=0.01).fit(data)
 	clustering = DBSCAN(0.01).fit(data)
 	return [np.mean(data[clustering.labels_==i], axis=0) for i in range(clustering.labels_.max()+1)]
@@ -331,8 +411,46 @@ def predict(df):
 	return df.groupby('oid', group_keys=False).apply(apply_pred)
 
 
+def shards(df, n):
+	'''
+	Split a frame sorted by oid into n shards of whole trajectories with about the same number of records
+	(largest trajectories first, each to the shard with the fewest records so far)
+	'''
+	sizes = df.groupby('oid', sort=False).size().sort_values(ascending=False, kind='stable')
+	heap = [(0, i) for i in range(n)]
+	assignment = {}
+	for oid, size in sizes.items():
+		records, i = heapq.heappop(heap)
+		assignment[oid] = i
+		heapq.heappush(heap, (records + size, i))
+	shard = df.oid.map(assignment).values
+	return [part for part in (df.loc[shard == i] for i in range(n)) if len(part)]
+
+def _run_stages(df, stages):
+	'''
+	Run (stage name, args) stages on a shard in a worker, without the per shard timing
+	'''
+	for name, args in stages:
+		df = globals()[name].__wrapped__(df, *args)
+	return df
+
+def parallel(df, stages, workers):
+	'''
+	Run per-trajectory stages, given as (function, *args) tuples, on df in a pool of workers processes.
+	df is split in balanced shards by oid (see shards), every shard goes through all the stages in one
+	worker and the results are put back in oid order. Stages must not depend on other trajectories.
+	'''
+	stages = [(stage[0].__name__, stage[1:]) for stage in stages]
+	start_time = time.perf_counter()
+	with ProcessPoolExecutor(workers) as pool:
+		results = list(pool.map(_run_stages, shards(df, workers), [stages]*workers))
+	result = pd.concat(results).sort_values(by='oid', kind='stable').reset_index(drop=True)
+	total_time = time.perf_counter() - start_time
+	print(f'Function {"+".join(name for name, _ in stages)} Took {total_time:.4f} seconds on {workers} workers')
+	return result
+
 @timeit
-def main(input_path, oid, ts, feature, ts_unit='s'):
+def main(input_path, oid, ts, feature, ts_unit='s', workers=1, rate_window=None):
 	
 	df = read_csv(input_path)
 	
@@ -342,11 +460,15 @@ def main(input_path, oid, ts, feature, ts_unit='s'):
 
 	df = drop_outliers(df, feature, 3)
 
-	df = speed_bearing(df)
+	if workers > 1:
+		# The gap threshold is over all trajectories, the rest is per trajectory
+		df = parallel(df, [(speed_bearing,), (resample_gaps, gap_threshold(df), rate_window), (trips,)], workers)
+	else:
+		df = speed_bearing(df)
 
-	df = resample_gaps(df)
+		df = resample_gaps(df, rate_window=rate_window)
 
-	df = trips(df)
+		df = trips(df)
 	
 	stops = stopages(df)
 
@@ -359,13 +481,182 @@ def main(input_path, oid, ts, feature, ts_unit='s'):
 	return df, stops	
 	# return df, stops, compressed
 
+def concat(frames):
+	'''
+	pd.concat of the non empty frames (of all of them when they are all empty), so that empty ones do not
+	take part in the dtypes of the result
+	'''
+	return pd.concat([frame for frame in frames if len(frame)] or frames)
+
+@timeit
+def main_stream(input_path, oid, ts, feature, ts_unit='s', chunksize=100000, output=None, sample_size=100000,
+		idle=None, bounds=None, threshold=None, rate_window=RATE_WINDOW):
+	'''
+	Streaming version of main for inputs larger than memory, e.g. multi-day AIS dumps (ordered by time).
+	The input is read chunksize records at a time. The sampling rate of a trajectory is the median of its
+	first rate_window intervals, so its records are held back until it has rate_window+1 of them (or the
+	input ends). After that, every chunk goes through the pipeline joined with the last record of each of
+	its trajectories and their running state (rate, number of records, gaps and trips so far), so the
+	output does not depend on the chunk size and is the same as the one of main(rate_window=rate_window).
+	main uses the median of the whole trajectory by default, so the resampled records of trajectories
+	whose sampling rate changes after their first rate_window intervals differ from it.
+	Records older than the last one of their trajectory are dropped.
+	The outlier bounds ({feature: (low, high)}) and the gap threshold are computed on the first chunk
+	unless given, object ids are numbered in order of appearance and stopages are clustered on a sample
+	of at most sample_size records.
+	Results are appended to output (csv) chunk by chunk, so memory is bounded by the chunk size plus the
+	state of the open trajectories: rate_window+1 records for the new ones, one record for the rest.
+	Without idle, every trajectory stays open to the end of the input. With idle (seconds), trajectories
+	without records for idle seconds (of input time) are closed; a later record of the same object starts
+	a new trajectory.
+	Returns the number of records written and the stopages
+	'''
+	features = feature.split(',') if type(feature) != list else feature
+	ids = {}
+	# Records of each object so far, for rid
+	seen = pd.Series(dtype=np.int64)
+	# Records of the trajectories that do not have their sampling rate yet
+	held = pd.DataFrame()
+	# Last record and state of every other open trajectory
+	carry = pd.DataFrame()
+	state = pd.DataFrame({'rate': pd.Series(dtype=np.float64), 'records': pd.Series(dtype=np.int64),
+		'gaps': pd.Series(dtype=np.int64), 'trips': pd.Series(dtype=np.int64)})
+	columns = None
+	stopped = []
+	written = 0
+
+	def write(records):
+		nonlocal columns, written
+		records = records.drop(columns=['_carry'])
+		if columns is None:
+			columns = list(records.columns)
+		if output is not None:
+			records.reindex(columns=columns).to_csv(output, mode='a' if written else 'w', header=not written, index=False)
+		written += len(records)
+		stopped.append(records.loc[records.status==0, ['lon', 'lat']].sample(frac=0.1))
+		if sum(map(len, stopped)) > sample_size:
+			stopped[:] = [pd.concat(stopped).sample(n=sample_size)]
+
+	def process(records):
+		'''
+		Run the per-trajectory stages on records (sorted by oid and ts) of open trajectories or of new ones
+		from their first record, write them and keep the state of their trajectories
+		'''
+		nonlocal carry, state
+		oids = pd.unique(records.oid)
+		known = state.index.intersection(oids)
+		new = records.loc[~records.oid.isin(known)]
+		df = concat([carry.loc[known].assign(_carry=True), records.assign(_carry=False)])
+		df = df.sort_values(by=['oid', 'ts'], kind='stable').reset_index(drop=True)
+		rates = concat([state.rate.loc[known], sampling_rate(new, rate_window)])
+		lengths = state.records.reindex(oids).fillna(0).astype(np.int64) + records.groupby('oid').size().reindex(oids)
+
+		# Carried records are written already, they are only the previous record of the next one
+		carried = (df._carry == True).values
+		values = df.loc[carried, ['sp', 'br']].values if carried.any() else None
+		df = speed_bearing.__wrapped__(df)
+		if values is not None:
+			df.loc[carried, ['sp', 'br']] = values
+		df = resample_gaps.__wrapped__(df, threshold, rates=rates, lengths=lengths, first_gap=state.gaps)
+		if 'gap_id' not in df:
+			df['gap_id'] = np.nan
+		df['status'] = (df.sp >= 1).astype(int)
+		start = df.oid.map(state.trips).fillna(0).astype(np.int64).values
+		df['tid'], trip_counts = trip_ids(df.oid.values, df.status.values, start)
+
+		# Resampled records have no _carry
+		real = df._carry.notna().values
+		last = df.loc[real].groupby('oid').tail(1)
+		real_oids = df.oid.values[real]
+		gaps = find_gaps(real_oids, df.ts.values[real].astype('datetime64[ns]').astype(np.int64), threshold)
+		gaps = pd.Series(real_oids[gaps]).value_counts().reindex(oids).fillna(0).astype(np.int64)
+		gaps = gaps.where(lengths >= 3, 0)
+		updated = pd.DataFrame({
+			'rate': rates.reindex(oids),
+			'records': lengths,
+			'gaps': state.gaps.reindex(oids).fillna(0).astype(np.int64) + gaps,
+			'trips': pd.Series(trip_counts[last.index], index=last.oid.values).reindex(oids),
+		}, index=oids)
+		state = concat([state.drop(known), updated])
+		carry = concat([carry.drop(known), last.drop(columns=['_carry']).set_index(last.oid.values)])
+		write(df.loc[df._carry != True])
+
+	def close(oids):
+		'''
+		Forget the state of closed trajectories
+		'''
+		nonlocal seen, carry, state
+		seen = seen.drop(oids, errors='ignore')
+		carry = carry.drop(oids, errors='ignore')
+		state = state.drop(oids, errors='ignore')
+
+	for chunk in pd.read_csv(input_path, chunksize=chunksize):
+		for value in sorted(set(chunk[oid].unique()) - ids.keys()):
+			ids[value] = len(ids)
+		chunk['oid'] = chunk[oid].map(ids)
+		chunk['ts'] = to_datetime(chunk[ts], ts_unit)
+		chunk = chunk.sort_values(by=['oid', 'ts'])
+		tails = [frame.groupby('oid').ts.max() for frame in (carry, held) if len(frame)]
+		last_ts = pd.concat(tails) if tails else pd.Series(dtype='datetime64[ns]')
+		# NaT for new objects (Series.map of an empty datetime Series does not work in pandas 3)
+		previous = last_ts.reindex(chunk.oid.values).values
+		older = chunk.ts.values < previous
+		chunk, previous = chunk.loc[~older], previous[~older]
+		# As in init_df, rid counts every record of the object, duplicates and outliers included
+		chunk['rid'] = chunk.groupby('oid').cumcount() + chunk.oid.map(seen).fillna(0).astype(np.int64).values
+		seen = seen.add(chunk.groupby('oid').size(), fill_value=0).astype(np.int64)
+		chunk = chunk.loc[~(chunk.ts.values == previous)].drop_duplicates(['oid', 'ts'])
+
+		if bounds is None:
+			bounds = {name: calc_outliers(chunk[name], 3)[1:] for name in features}
+		for name, (low, high) in bounds.items():
+			chunk = chunk.loc[~((chunk[name] > high) | (chunk[name] < low))]
+		if threshold is None:
+			threshold = gap_threshold(chunk)
+
+		# Trajectories get their sampling rate from their first rate_window+1 records
+		known = chunk.oid.isin(state.index)
+		young = concat([held, chunk.loc[~known]]).sort_values(by=['oid', 'ts'], kind='stable')
+		ready = (young.groupby('oid').oid.transform('size') > rate_window).values
+		held = young.loc[~ready]
+		records = concat([chunk.loc[known], young.loc[ready]]).sort_values(by=['oid', 'ts'], kind='stable')
+		if len(records):
+			process(records)
+
+		if idle is not None and len(chunk):
+			cutoff = chunk.ts.max() - pd.Timedelta(seconds=idle)
+			if len(held):
+				ended = held.groupby('oid').ts.max()
+				ended = ended.index[ended < cutoff]
+				if len(ended):
+					process(held.loc[held.oid.isin(ended)])
+					held = held.loc[~held.oid.isin(ended)]
+			if len(carry):
+				close(carry.index[carry.ts < cutoff])
+
+	# Trajectories that ended before getting rate_window+1 records
+	if len(held):
+		process(held)
+
+	stops = cluster_stops(pd.concat(stopped).values) if written else []
+	return written, stops
+
 if __name__=='__main__':
+	# Workers of the frozen (pyinstaller) executable start through it
+	multiprocessing.freeze_support()
 	parser = argparse.ArgumentParser()
 	parser.add_argument('input', metavar='FILE', help='Input file path')
 	parser.add_argument('--oid', dest='oid', required=True, metavar='COLUMN', nargs="?", help='Specify the column with the unique ID for each object')
 	parser.add_argument('--ts', dest='ts', required=True,  metavar='COLUMN', nargs="?", help='Column containing time information')
 	parser.add_argument('--feature', dest='feature', required=True,  metavar='COLUMN', nargs="?", help='Feature that will be used for outlier drop')
 	parser.add_argument('--ts-unit', dest='ts_unit',  metavar='str', nargs="?", default = 's', help='The unit of the arg (D,s,ms,us,ns) denote the unit, which is an integer or float number. Default="s"')
+	parser.add_argument('--workers', dest='workers', type=int, metavar='N', default=1, help='Run the per-trajectory stages in N processes (0 for one per core). Default=1')
+	parser.add_argument('--chunksize', dest='chunksize', type=int, metavar='N', help='Stream the input N records at a time (see main_stream)')
+	parser.add_argument('--output', dest='output', metavar='FILE', help='Write the records of the streaming mode to FILE (csv)')
+	parser.add_argument('--idle', dest='idle', type=float, metavar='SECONDS', help='In streaming mode, close trajectories without records for SECONDS')
 	args = parser.parse_args()
 
-	main(args.input, args.oid, args.ts, args.feature, args.ts_unit)
\ No newline at end of file
+	if args.chunksize:
+		main_stream(args.input, args.oid, args.ts, args.feature, args.ts_unit, args.chunksize, args.output, idle=args.idle)
+	else:
+		main(args.input, args.oid, args.ts, args.feature, args.ts_unit, args.workers or os.cpu_count())
\ No newline at end of file
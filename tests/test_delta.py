@@ -0,0 +1,91 @@
+"""
+Tests for the block delta transfer (delta.py), with the target side scripts run locally.
+"""
+
+import hashlib
+import subprocess
+import sys
+import zlib
+
+import numpy as np
+import pytest
+
+import delta
+
+
+def _signatures(path):
+    output = subprocess.run([sys.executable, '-c', delta.SIGNATURE_SCRIPT, str(path)], capture_output=True,
+                            check=True).stdout
+    return delta.parse_signatures(output)
+
+
+def _patch(path, data, block_size, changes):
+    return subprocess.run([sys.executable, '-c', delta.PATCH_SCRIPT, str(path), hashlib.md5(data).hexdigest(),
+                           str(block_size)], input=changes, capture_output=True)
+
+
+@pytest.mark.parametrize('block_size', [1, 7, 64, 1000])
+def test_rolling_adler32_matches_zlib(block_size):
+    data = np.random.default_rng(1).integers(0, 256, size=1000, dtype=np.uint8)
+    raw = data.tobytes()
+
+    expected = [zlib.adler32(raw[start:start + block_size]) for start in range(len(raw) - block_size + 1)]
+
+    assert delta.rolling_adler32(data, block_size).tolist() == expected
+
+
+def test_parse_signatures_keeps_first_of_identical_blocks():
+    output = b'2048\n11 aa\n22 bb\n11 aa\n11 cc\n'
+
+    assert delta.parse_signatures(output) == (2048, {11: {'aa': 0, 'cc': 3}, 22: {'bb': 1}})
+
+
+def test_compute_delta_copies_unchanged_blocks(tmp_path):
+    old = np.random.default_rng(2).integers(0, 256, size=200000, dtype=np.uint8).tobytes()
+    path = tmp_path / 'data.bin'
+    path.write_bytes(old)
+    block_size, signatures = _signatures(path)
+    new = old[:100000] + b'changed' + old[100000:]
+
+    changes = delta.compute_delta(new, block_size, signatures)
+
+    # A literal around the edit, every other block is copied
+    assert len(changes) < 3 * block_size
+
+
+@pytest.mark.parametrize('edit', [
+    lambda old: old,
+    lambda old: b'prefix' + old,
+    lambda old: old[:70000] + old[90000:] + b'suffix',
+    lambda old: old[5000:150000],
+    lambda old: old[100000:] + old[:100000],
+    lambda old: b'',
+    lambda old: bytes(reversed(old)),
+])
+def test_compute_delta_round_trip(tmp_path, edit):
+    old = np.random.default_rng(3).integers(0, 256, size=200000, dtype=np.uint8).tobytes()
+    path = tmp_path / 'data.bin'
+    path.write_bytes(old)
+    new = edit(old)
+    block_size, signatures = _signatures(path)
+
+    result = _patch(path, new, block_size, delta.compute_delta(new, block_size, signatures))
+
+    assert result.returncode == 0, result.stderr
+    assert path.read_bytes() == new
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_patch_script_keeps_the_file_on_checksum_mismatch(tmp_path):
+    old = b'x' * 10000
+    path = tmp_path / 'data.bin'
+    path.write_bytes(old)
+    block_size, signatures = _signatures(path)
+    changes = delta.compute_delta(b'y' * 10000, block_size, signatures)
+
+    result = _patch(path, b'z' * 10000, block_size, changes)
+
+    assert result.returncode == 1
+    assert b'checksum mismatch' in result.stderr
+    assert path.read_bytes() == old
+    assert list(tmp_path.iterdir()) == [path]
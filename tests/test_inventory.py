@@ -0,0 +1,71 @@
+"""
+Tests for host selection (inventory.py) on a hosts file written per test.
+"""
+
+import json
+import os
+
+import pytest
+
+import inventory
+
+HOSTS = {
+    'gw': {'ip': '10.0.0.1', 'master_callsign': '', 'tags': ['edge']},
+    'web1': {'ip': '10.0.1.1', 'master_callsign': 'gw', 'tags': ['web', 'canary']},
+    'web2': {'ip': '10.0.1.2', 'master_callsign': 'gw', 'tags': ['web']},
+    'web10': {'ip': '10.0.1.10', 'master_callsign': 'gw', 'tags': ['web']},
+    'db1': {'ip': '10.0.2.1', 'master_callsign': 'web1'},
+    'solo': {'ip': '10.0.3.1', 'master_callsign': ''},
+}
+
+
+@pytest.fixture
+def hosts_file(tmp_path):
+    path = tmp_path / 'hosts.json'
+    path.write_text(json.dumps(HOSTS))
+    return str(path)
+
+
+@pytest.mark.parametrize('selector, expected', [
+    ('', ['gw', 'web1', 'web2', 'web10', 'db1', 'solo']),
+    ('solo', ['solo']),
+    # An exact name is not also a prefix
+    ('web1', ['gw', 'web1']),
+    ('web', ['gw', 'web1', 'web2', 'web10']),
+    ('@canary', ['gw', 'web1']),
+    ('web?', ['gw', 'web1', 'web2']),
+    ('web*,!web1', ['gw', 'web2', 'web10']),
+    # Excluded masters of selected hosts are still added to reach them
+    ('!web,!gw', ['gw', 'web1', 'db1', 'solo']),
+    ('!web,!gw,!db1', ['solo']),
+    ('nothing', []),
+])
+def test_select(hosts_file, selector, expected):
+    assert list(inventory.select(selector, hosts_file)) == expected
+
+
+def test_select_marks_masters_only_added_as_jump_hosts(hosts_file):
+    selected = inventory.select('db1', hosts_file)
+
+    assert list(selected) == ['gw', 'web1', 'db1']
+    assert selected['gw']['jump'] and selected['web1']['jump']
+    assert 'jump' not in selected['db1']
+    assert 'jump' not in inventory.select('gw,web1', hosts_file)['gw']
+
+
+def test_select_returns_copies(hosts_file):
+    inventory.select('solo', hosts_file)['solo']['client'] = object()
+
+    assert 'client' not in inventory.select('solo', hosts_file)['solo']
+
+
+def test_load_reloads_a_changed_file(hosts_file):
+    assert inventory.load(hosts_file) is inventory.load(hosts_file)
+    assert 'new' not in inventory.select('', hosts_file)
+
+    with open(hosts_file, 'w') as f:
+        json.dump(dict(HOSTS, new={'ip': '10.0.4.1', 'master_callsign': ''}), f)
+    stat = os.stat(hosts_file)
+    os.utime(hosts_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    assert 'new' in inventory.select('', hosts_file)
@@ -0,0 +1,130 @@
+"""
+Tests for the py_bench module pipeline (modules/py_bench/main.py).
+
+They are skipped when the module's own requirements are not installed.
+"""
+
+import importlib.util
+import os
+import time
+
+import pytest
+
+for requirement in ('pandas', 'numpy', 'haversine', 'scipy', 'sklearn', 'dtw', 'pyproj', 'geopandas', 'shapely',
+                    'dateutil'):
+    pytest.importorskip(requirement)
+
+import numpy as np
+import pandas as pd
+
+MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'modules', 'py_bench', 'main.py')
+
+
+@pytest.fixture(scope='module')
+def py_bench():
+    spec = importlib.util.spec_from_file_location('py_bench_main', MAIN)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def local_timezone(monkeypatch):
+    '''
+    Runs the test with a local timezone away from UTC
+    '''
+    monkeypatch.setenv('TZ', 'Europe/Athens')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_to_datetime_naive_strings_are_utc(py_bench, local_timezone):
+    expected = pd.Series(pd.to_datetime(['2015-10-01 00:00:00', '2015-10-01 00:00:30', '2015-10-01 00:01:00']))
+    same_format = pd.Series(['2015-10-01 00:00:00', '2015-10-01 00:00:30', '2015-10-01 00:01:00'])
+    # Mixed formats take the per record parsing path
+    mixed_format = pd.Series(['2015-10-01 00:00:00', '01 Oct 2015 00:00:30', '2015/10/01 00:01'])
+
+    assert (py_bench.to_datetime(same_format, 's') == expected).all()
+    assert (py_bench.to_datetime(mixed_format, 's') == expected).all()
+
+
+def test_to_datetime_aware_strings_are_converted_to_utc(py_bench, local_timezone):
+    mixed_format = pd.Series(['2015-10-01 03:00:00+03:00', '01 Oct 2015 00:00:30 +0000'])
+
+    assert py_bench.to_datetime(mixed_format, 's').tolist() == [
+        pd.Timestamp('2015-10-01 00:00:00'), pd.Timestamp('2015-10-01 00:00:30')
+    ]
+
+
+def test_to_datetime_epochs(py_bench):
+    assert py_bench.to_datetime(pd.Series([1443657600, 1443657630]), 's').tolist() == [
+        pd.Timestamp('2015-10-01 00:00:00'), pd.Timestamp('2015-10-01 00:00:30')
+    ]
+    assert py_bench.to_datetime(pd.Series([1443657600.5]), 's').tolist() == [pd.Timestamp('2015-10-01 00:00:00.5')]
+    with pytest.raises(TypeError):
+        py_bench.to_datetime(pd.Series([True, False]), 's')
+
+
+@pytest.fixture
+def ais_csv(tmp_path):
+    '''
+    Synthetic AIS dump ordered by time, with sampling gaps, duplicates, outliers and single record vessels
+    '''
+    rng = np.random.default_rng(4)
+    vessels = []
+    for vessel in range(30):
+        records = 1 if vessel % 7 == 0 else int(rng.integers(2, 300))
+        interval = rng.choice([10, 30, 60], size=records)
+        if records > 5:
+            interval[rng.integers(1, records, size=3)] = rng.integers(600, 5000, size=3)
+        vessels.append(pd.DataFrame({
+            'sourcemmsi': 200000000 + vessel,
+            't': 1443650400 + np.cumsum(interval),
+            'lon': -4.5 + np.cumsum(rng.normal(0, 0.001, records)),
+            'lat': 48 + np.cumsum(rng.normal(0, 0.001, records)),
+            'speedoverground': rng.uniform(0, 15, records),
+        }))
+    df = pd.concat(vessels)
+    df = pd.concat([df, df.sample(50, random_state=1)])
+    df.loc[df.sample(20, random_state=2).index, 'speedoverground'] = 500
+    path = tmp_path / 'ais.csv'
+    df.sort_values('t', kind='stable').to_csv(path, index=False)
+    return str(path)
+
+
+def _records(df):
+    # Object ids are numbered differently, records are compared by vessel and time
+    df = df.sort_values(['sourcemmsi', 'ts', 'gap_id'], na_position='first', kind='stable').reset_index(drop=True)
+    return df[['sourcemmsi', 'ts', 'lat', 'lon', 'speedoverground', 'sp', 'br', 'rid', 'gap_id', 'status', 'tid']]
+
+
+@pytest.mark.parametrize('chunksize', [10**6, 997, 200, 60, 7])
+def test_main_stream_matches_main(py_bench, ais_csv, tmp_path, chunksize):
+    # Streaming estimates sampling rates on the first intervals of trajectories, main on the whole ones
+    expected, _ = py_bench.main(ais_csv, 'sourcemmsi', 't', 'speedoverground', rate_window=py_bench.RATE_WINDOW)
+    # The global statistics of main, that streaming computes on its first chunk otherwise
+    base = py_bench.drop_duplicates(py_bench.init_df(pd.read_csv(ais_csv), 'sourcemmsi', 't', 's'), ['oid', 'ts'])
+    bounds = {'speedoverground': py_bench.calc_outliers(base.speedoverground, 3)[1:]}
+    threshold = py_bench.gap_threshold(py_bench.drop_outliers(base, 'speedoverground', 3))
+    output = str(tmp_path / 'out.csv')
+
+    written, _ = py_bench.main_stream(ais_csv, 'sourcemmsi', 't', 'speedoverground', chunksize=chunksize,
+                                      output=output, bounds=bounds, threshold=threshold)
+
+    assert expected.gap_id.notna().any()
+    assert written == len(expected)
+    pd.testing.assert_frame_equal(_records(pd.read_csv(output, parse_dates=['ts'])), _records(expected),
+                                  check_dtype=False)
+
+
+def test_main_stream_closes_idle_trajectories(py_bench, ais_csv, tmp_path):
+    output = str(tmp_path / 'out.csv')
+
+    py_bench.main_stream(ais_csv, 'sourcemmsi', 't', 'speedoverground', chunksize=60, output=output, idle=3600)
+
+    records = pd.read_csv(output, parse_dates=['ts']).sort_values(['sourcemmsi', 'ts'], kind='stable')
+    # A vessel coming back after an hour starts a new trajectory
+    restarts = records.loc[records.gap_id.isna()].groupby('sourcemmsi').rid.apply(lambda rid: (rid.diff() < 0).sum())
+    assert restarts.sum() > 0
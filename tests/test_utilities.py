@@ -0,0 +1,147 @@
+"""
+Tests for the local helpers of utilities.py: module diffs, the commit log, host status and job parsing.
+"""
+
+import json
+
+import pytest
+
+from utilities import CommitStore, ModuleDiff, StatusCache, parse_jobs, parse_probe
+
+
+def test_module_diff_updated_new_and_deleted():
+    diff = ModuleDiff.compare({'a': '1', 'b': '2', 'c': '3'}, {'a': '1', 'b': 'old', 'd': '4'})
+
+    assert diff.as_dict() == {'new': ['c'], 'updated': ['b'], 'moved': [], 'renamed': [], 'deleted': ['d']}
+    assert diff.has_changes()
+    assert not ModuleDiff.compare({'a': '1'}, {'a': '1'}).has_changes()
+
+
+def test_module_diff_moves_and_renames():
+    diff = ModuleDiff.compare({'x/f': '1', 'x/g': '2'}, {'y/f': '1', 'x/h': '2'})
+
+    assert diff.moved == [{'source': 'x/f', 'target': 'y/f'}]
+    assert diff.renamed == [{'source': 'x/g', 'target': 'x/h'}]
+    assert diff.new == [] and diff.deleted == []
+
+
+def test_module_diff_prefers_same_name_then_same_dir():
+    target = {'a/f': '1', 'b/f': '1', 'c/g': '1'}
+
+    diff = ModuleDiff.compare({'c/f': '1', 'b/x': '1'}, target)
+
+    # c/f takes a/f (same basename, first in sorted order) over c/g (same dir)
+    assert diff.moved == [{'source': 'c/f', 'target': 'a/f'}]
+    assert diff.renamed == [{'source': 'b/x', 'target': 'b/f'}]
+    assert diff.deleted == ['c/g']
+
+
+def test_module_diff_never_pairs_empty_hashes():
+    diff = ModuleDiff.compare({'a/f': ''}, {'b/f': ''})
+
+    assert diff.new == ['a/f']
+    assert diff.deleted == ['b/f']
+    assert diff.moved == diff.renamed == []
+
+
+def test_commit_store_history(tmp_path):
+    store = CommitStore(str(tmp_path), 'mod', snapshot_every=3)
+    versions = [['a', 'b'], ['a', 'b', 'c'], ['b', 'c'], ['c', 'd', 'e'], []]
+
+    for files in versions:
+        store.append(files, hosts=['h2', 'h1'])
+
+    head = store.head()
+    assert head['id'] == len(versions) and head['files_in_commit'] == []
+    assert head['hosts'] == ['h1', 'h2']
+    assert [commit['files_in_commit'] for commit in store.history()] == versions
+    assert [commit['id'] for commit in store.history()] == [1, 2, 3, 4, 5]
+
+
+def test_commit_store_compaction_keeps_the_last_commits(tmp_path):
+    store = CommitStore(str(tmp_path), 'mod', retention=5, snapshot_every=3)
+    versions = [[f'file{i}', f'file{i + 1}'] for i in range(20)]
+
+    for files in versions:
+        store.append(files)
+
+    history = list(store.history())
+    with open(store.log_dir) as f:
+        entries = [json.loads(line) for line in f]
+    assert len(history) <= 5 + 3
+    assert [commit['files_in_commit'] for commit in history] == versions[-len(history):]
+    assert 'snapshot' in entries[0]
+    assert store.head()['log_entries'] == len(entries)
+    assert store.head()['id'] == 20
+
+
+def test_commit_store_migrates_the_legacy_image(tmp_path):
+    legacy = {
+        '1': {'commit_date': '2024-01-01 00:00:00', 'files_in_commit': ['a'], 'hosts': ['h1']},
+        '2': {'commit_date': '2024-01-02 00:00:00', 'files_in_commit': ['a', 'b']},
+    }
+    store = CommitStore(str(tmp_path), 'mod')
+    with open(store.legacy_dir, 'w') as f:
+        json.dump(legacy, f)
+
+    head = store.head()
+
+    assert head['id'] == 2 and head['files_in_commit'] == ['a', 'b']
+    assert [commit['files_in_commit'] for commit in store.history()] == [['a'], ['a', 'b']]
+    assert not (tmp_path / '.mod_commit_image.json').exists()
+    assert store.append(['b'])['id'] == 3
+
+
+def test_commit_store_without_commits(tmp_path):
+    store = CommitStore(str(tmp_path), 'mod')
+
+    assert store.head() == store.empty_commit()
+    assert list(store.history()) == []
+
+
+def test_parse_probe():
+    output = '\n'.join([
+        'load 0.52 0.42 0.38',
+        'mem 1024',
+        'disk ',
+        'job _emp_mod_1',
+        'module mod 452db3f92b83 1700000000',
+        'module old 1a2b3c',
+    ])
+
+    assert parse_probe(output) == {
+        'reachable': True, 'load': [0.52, 0.42, 0.38], 'mem_free': 1024 * 1024, 'disk_free': None,
+        'jobs': ['_emp_mod_1'],
+        'modules': {
+            'mod': {'version': '452db3f92b83', 'deployed': 1700000000},
+            'old': {'version': '1a2b3c', 'deployed': None},
+        },
+    }
+
+
+def test_parse_jobs_oldest_first():
+    output = '\n'.join([
+        'job mod_2 running 10 mod 1700000200',
+        'job mod_1 0 2048 mod 1700000100',
+        'job lost_1 lost 0',
+        'garbage',
+        'job short',
+    ])
+
+    assert parse_jobs(output) == [
+        {'job': 'lost_1', 'status': 'lost', 'stdout_bytes': 0, 'module': None, 'start': None},
+        {'job': 'mod_1', 'status': '0', 'stdout_bytes': 2048, 'module': 'mod', 'start': 1700000100},
+        {'job': 'mod_2', 'status': 'running', 'stdout_bytes': 10, 'module': 'mod', 'start': 1700000200},
+    ]
+
+
+@pytest.mark.parametrize('ttl', [0, 30])
+def test_status_cache(tmp_path, ttl):
+    path = str(tmp_path / 'emp' / 'status.json')
+    cache = StatusCache(path, ttl).load()
+
+    entry = cache.put('h1', {'reachable': False})
+    cache.save()
+
+    assert entry['reachable'] is False and 'checked' in entry
+    assert StatusCache(path, ttl).load().get('h1') == (entry if ttl else None)
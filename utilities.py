@@ -13,6 +13,18 @@ from termcolor import colored
 from numpy import unique
 from datetime import datetime
 import os
+import sys
+import shlex
+import select
+import time
+import queue
+import tarfile
+from collections import deque
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import delta
 
 # Import logging configuration
 import log_utils
@@ -26,11 +38,20 @@ def time_str():
     """
     return datetime.now().strftime('%H:%M:%S.%f')[:-3]
 
+def verbosity():
+    """
+    Returns the verbosity level of the current output: its own if it has
+    one (e.g. the output of an agent request), else the V variable
+    """
+    level = getattr(sys.stdout, 'verbosity', None)
+    return int(os.getenv('V', '0')) if level is None else level
+
+
 def scribe(msg, hostname=None, color=None):
     """
     Returns the current timestamp formatted as hh:mm:ss.ms
     """
-    vl = int(os.getenv('V', '0'))
+    vl = verbosity()
 
     if hostname is None:
         if color is None:
@@ -47,6 +68,161 @@ def scribe(msg, hostname=None, color=None):
 
 
 
+class OutputCapture:
+    """
+    Bounded in-memory capture of a command's output: the total number of
+    bytes of each stream and the last limit bytes of each
+    """
+
+    def __init__(self, limit=64 * 1024):
+        self.limit = limit
+        self.buffers = {'stdout': bytearray(), 'stderr': bytearray()}
+        self.sizes = {'stdout': 0, 'stderr': 0}
+
+    def feed(self, stream, data):
+        buffer = self.buffers[stream]
+        buffer += data
+        self.sizes[stream] += len(data)
+        if len(buffer) > self.limit:
+            del buffer[:len(buffer) - self.limit]
+
+    def tail(self, stream):
+        return self.buffers[stream].decode(errors='replace')
+
+
+class RunResult:
+    """
+    Outcome of a module run on a host: the phase it reached (sync, build,
+    run or done), the exit code of that phase, timing and the size and tail
+    of the run's output
+    """
+
+    def __init__(self, hostname, module, detached=False):
+        self.hostname = hostname
+        self.module = module
+        self.detached = detached
+        # Id of the detached job started by the run
+        self.job = None
+        self.phase = 'sync'
+        self.exit_code = None
+        self.error = None
+        self.changed = False
+        self.built = False
+        self.start = time.time()
+        self.end = None
+        self.capture = OutputCapture(limit=4096)
+
+    @property
+    def ok(self):
+        return self.phase == 'done' and self.exit_code == 0
+
+    def finish(self, exit_code=None, error=None):
+        self.exit_code = exit_code
+        self.error = error
+        if error is None and exit_code == 0 and self.phase == 'run':
+            self.phase = 'done'
+        self.end = time.time()
+        return self
+
+    def as_dict(self):
+        return {
+            'host': self.hostname,
+            'module': self.module,
+            'detached': self.detached,
+            'job': self.job,
+            'ok': self.ok,
+            'phase': self.phase,
+            'exit_code': self.exit_code,
+            'error': self.error,
+            'changed': self.changed,
+            'built': self.built,
+            'start': self.start,
+            'end': self.end,
+            'duration': None if self.end is None else self.end - self.start,
+            'stdout_bytes': self.capture.sizes['stdout'],
+            'stderr_bytes': self.capture.sizes['stderr'],
+            'stdout_tail': self.capture.tail('stdout'),
+            'stderr_tail': self.capture.tail('stderr'),
+        }
+
+
+class JsonLinesReport:
+    """
+    Appends one JSON object per line to a report file as results come in,
+    safe to share between threads
+    """
+
+    def __init__(self, report_dir):
+        self.report_dir = report_dir
+        self.lock = Lock()
+
+    def write(self, record):
+        with self.lock, open(self.report_dir, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+
+
+def stream_channel(channel, hostname=None, capture=None, timeout=None, echo=True, chunk_size=32768):
+    """
+    Reads stdout and stderr of a paramiko channel as they arrive, printing
+    complete lines tagged by hostname (unless echo is False) and feeding the
+    optional capture. Closes the channel after timeout seconds.
+    Returns the exit status, -1 on timeout
+    """
+    pending = {'stdout': b'', 'stderr': b''}
+    colors = {'stdout': 'green', 'stderr': 'red'}
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    def feed(stream, data):
+        if capture is not None:
+            capture.feed(stream, data)
+        *lines, pending[stream] = (pending[stream] + data).split(b'\n')
+        if echo:
+            for line in lines:
+                scribe(line.rstrip(b'\r').decode(errors='replace'), hostname=hostname, color=colors[stream])
+
+    while True:
+        wait = 1 if deadline is None else max(0, min(1, deadline - time.monotonic()))
+        select.select([channel], [], [], wait)
+        while channel.recv_ready():
+            feed('stdout', channel.recv(chunk_size))
+        while channel.recv_stderr_ready():
+            feed('stderr', channel.recv_stderr(chunk_size))
+        # The exit status arrives after all output, so nothing is left unread
+        if channel.exit_status_ready() or channel.closed:
+            if not channel.recv_ready() and not channel.recv_stderr_ready():
+                break
+        if deadline is not None and time.monotonic() >= deadline:
+            channel.close()
+            break
+
+    for stream in pending:
+        if pending[stream]:
+            feed(stream, b'\n')
+    return channel.recv_exit_status()
+
+
+def timed_command(command, timeout=None):
+    """
+    Wraps a shell command so that the host itself stops it shortly after
+    timeout seconds: without a pty, closing the channel on timeout does not
+    hang up the remote process
+    """
+    if timeout is None:
+        return command
+    return f'timeout -k 5 {int(timeout) + 5} bash -c {shlex.quote(command)}'
+
+
+def format_table(rows, headers):
+    """
+    Returns rows formatted as a plain text table with left aligned columns
+    """
+    rows = [[str(value) for value in row] for row in rows]
+    widths = [max(len(str(value)) for value in column) for column in zip(headers, *rows)]
+    lines = ["  ".join(str(value).ljust(width) for value, width in zip(row, widths)).rstrip()
+             for row in [headers] + rows]
+    return "\n".join(lines)
+
+
 def parse_args(target: list) -> list:
     """
     Parses the arguments and returns a dict of commands and args
@@ -71,36 +247,635 @@ def parse_file(path: str) -> list:
     return parse_args(commands)
 
 
+# Script executed on the target to hash a list of files in a single round trip.
+# File names are read NUL-separated from stdin and "<md5>\t<name>" records are
+# written NUL-terminated to stdout. Hashing mirrors VersionControl._hash_file
+# (4096 byte chunks, each chunk stripped) so both sides produce the same values.
+REMOTE_HASH_SCRIPT = """
+import hashlib, sys
+stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+for name in stdin.read().split(b'\\0'):
+    if not name:
+        continue
+    hash_md5 = hashlib.md5()
+    try:
+        with open(name, 'rb') as f:
+            for chunk in iter(lambda: f.read(4096), b''):
+                hash_md5.update(chunk.strip())
+        digest = hash_md5.hexdigest().encode()
+    except Exception:
+        digest = b''
+    stdout.write(digest + b'\\t' + name + b'\\0')
+stdout.flush()
+"""
+
+
+# Name of the file recording the deployed version of a module on the target,
+# as "<version> <deploy timestamp>"
+VERSION_FILE = '.emp_version'
+
+
+# Shell command gathering the status of a host in a single round trip, one
+# "<key> <value>" line per fact (sizes in KB)
+PROBE_COMMAND = r"""
+echo "load $(cut -d ' ' -f 1-3 /proc/loadavg 2>/dev/null)"
+echo "mem $(awk '/^MemAvailable:/ {print $2}' /proc/meminfo 2>/dev/null)"
+echo "disk $(df -Pk . 2>/dev/null | awk 'NR == 2 {print $4}')"
+tmux ls -F '#{session_name}' 2>/dev/null | grep '^_emp' | sed 's/^/job /'
+for f in modules/*/%s; do
+    [ -f "$f" ] && echo "module $(basename "$(dirname "$f")") $(cat "$f")"
+done
+true
+""" % VERSION_FILE
+
+
+def parse_probe(output):
+    """
+    Parses the output of PROBE_COMMAND into a status dict
+    """
+    status = {'reachable': True, 'load': None, 'mem_free': None, 'disk_free': None, 'jobs': [], 'modules': {}}
+    for line in output.splitlines():
+        key, _, value = line.strip().partition(' ')
+        value = value.strip()
+        if key == 'load' and value:
+            status['load'] = [float(v) for v in value.split()]
+        elif key in ('mem', 'disk') and value.isdigit():
+            status[f'{key}_free'] = int(value) * 1024
+        elif key == 'job':
+            status['jobs'].append(value)
+        elif key == 'module':
+            name, _, version = value.partition(' ')
+            version, _, deployed = version.partition(' ')
+            status['modules'][name] = {'version': version, 'deployed': int(deployed) if deployed.isdigit() else None}
+    return status
+
+
+class StatusCache:
+    """
+    Host status from recent checks, kept for ttl seconds
+    """
+
+    def __init__(self, cache_dir, ttl=30):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.entries = {}
+
+    def load(self):
+        try:
+            with open(self.cache_dir) as f:
+                self.entries = json.load(f)
+        except:
+            self.entries = {}
+        return self
+
+    def get(self, hostname):
+        """
+        Returns the cached status of a host if it is fresh, else None
+        """
+        entry = self.entries.get(hostname)
+        if entry and time.time() - entry['checked'] < self.ttl:
+            return entry
+        return None
+
+    def put(self, hostname, status):
+        """
+        Caches the status of a host and returns the cached entry
+        """
+        self.entries[hostname] = dict(status, checked=time.time())
+        return self.entries[hostname]
+
+    def save(self):
+        """
+        Atomically replaces the cache file
+        """
+        os.makedirs(self.cache_dir.rpartition('/')[0], exist_ok=True)
+        tmp_dir = f'{self.cache_dir}.{os.getpid()}.tmp'
+        with open(tmp_dir, 'w') as fp:
+            json.dump(self.entries, fp)
+        os.replace(tmp_dir, self.cache_dir)
+
+
+def human_size(size):
+    """
+    Returns a byte count as a short human readable string
+    """
+    if size is None:
+        return '-'
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024:
+            return f'{size:.0f}{unit}' if unit == 'B' else f'{size:.1f}{unit}'
+        size /= 1024
+    return f'{size:.1f}TB'
+
+
+# Directory on the target, relative to the home directory, holding a
+# directory per detached job with its "job" description ("<module> <start>"),
+# "stdout", "stderr" and, once finished, "exit_status"
+JOBS_DIR = '.emp/jobs'
+
+
+# Shell command listing the detached jobs of a host, one
+# "job <id> <status> <stdout size> <module> <start>" line per job, where
+# status is the exit code, running, or lost if the job ended without one
+JOBS_COMMAND = r"""
+for d in %s/*/; do
+    [ -d "$d" ] || continue
+    id=$(basename "$d")
+    status=$(cat "$d/exit_status" 2>/dev/null)
+    if [ -z "$status" ]; then
+        tmux has-session -t "_emp_$id" 2>/dev/null && status=running || status=lost
+    fi
+    echo "job $id $status $(wc -c < "$d/stdout" 2>/dev/null || echo 0) $(cat "$d/job" 2>/dev/null)"
+done
+true
+""" % JOBS_DIR
+
+
+def new_job_id(module):
+    """
+    Returns a unique id for a detached run of module
+    """
+    return f'{module}_{int(time.time() * 1000)}'
+
+
+def parse_jobs(output):
+    """
+    Parses the output of JOBS_COMMAND into a list of job dicts, oldest first
+    """
+    jobs = []
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) < 4 or fields[0] != 'job':
+            continue
+        module = fields[4] if len(fields) > 4 else None
+        start = int(fields[5]) if len(fields) > 5 and fields[5].isdigit() else None
+        jobs.append({
+            'job': fields[1], 'status': fields[2], 'stdout_bytes': int(fields[3]) if fields[3].isdigit() else 0,
+            'module': module, 'start': start,
+        })
+    return sorted(jobs, key=lambda job: job['start'] or 0)
+
+
+# Script executed on the target to stat a list of files in a single round trip.
+# Same input and output framing as REMOTE_HASH_SCRIPT, with "<size> <mtime>"
+# records (empty if the file is missing).
+REMOTE_STAT_SCRIPT = """
+import os, sys
+stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+for name in stdin.read().split(b'\\0'):
+    if not name:
+        continue
+    try:
+        st = os.stat(name)
+        record = ('%d %r' % (st.st_size, st.st_mtime)).encode()
+    except OSError:
+        record = b''
+    stdout.write(record + b'\\t' + name + b'\\0')
+stdout.flush()
+"""
+
+
+class HashCache:
+    """
+    Persistent cache of local file hashes, stored next to the commit image.
+    Entries are keyed by file path and reused while the file's stat
+    signature (size, mtime, inode) is unchanged
+    """
+
+    # Files modified this recently are hashed but not cached, as a later edit
+    # within the same mtime tick would otherwise go unnoticed
+    RACY_WINDOW = 2
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.entries = {}
+        self.changed = False
+
+    def load(self):
+        """
+        Loads cached entries from disk, starting empty if missing or corrupt
+        """
+        try:
+            with open(self.cache_dir) as f:
+                self.entries = json.load(f)
+        except:
+            self.entries = {}
+        return self
+
+    def save(self):
+        """
+        Atomically writes the cache to disk if any entry changed
+        """
+        if not self.changed:
+            return
+        tmp_dir = f'{self.cache_dir}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_dir, 'w') as fp:
+                json.dump(self.entries, fp)
+            os.replace(tmp_dir, self.cache_dir)
+            self.changed = False
+        except OSError as e:
+            logger.debug(f"Could not write hash cache {self.cache_dir}: {e}")
+
+    def checksum(self, files, strip_on, hash_file):
+        """
+        Returns a dictionary with every file and its hash value, only calling
+        hash_file for files whose stat signature is not in the cache
+        """
+        hash_dict = {}
+        entries = {}
+        racy_after = time.time_ns() - self.RACY_WINDOW * 10**9
+        for file in files:
+            fname = file.split(strip_on)[-1].strip("/")
+            try:
+                st = os.stat(file)
+                signature = [st.st_size, st.st_mtime_ns, st.st_ino]
+            except OSError:
+                signature = None
+
+            cached = self.entries.get(fname)
+            if signature is not None and cached and cached[:3] == signature:
+                file_hash = cached[3]
+                entries[fname] = cached
+            else:
+                file_hash = hash_file(file)
+                if signature is not None and file_hash and signature[1] < racy_after:
+                    entries[fname] = signature + [file_hash]
+            hash_dict[fname] = file_hash
+
+        if entries != self.entries:
+            self.entries = entries
+            self.changed = True
+        return hash_dict
+
+
+class CommitStore:
+    """
+    Commit history of a module: an append-only log of deltas against the
+    previous commit (with a full snapshot every snapshot_every commits) plus
+    a small head file holding the latest commit, so reading it is O(1).
+    Only the last retention commits are kept in the log
+    """
+
+    def __init__(self, source_dir, module_name, retention=500, snapshot_every=50):
+        self.log_dir = f'{source_dir}/.{module_name}_commits.log'
+        self.head_dir = f'{source_dir}/.{module_name}_commit_head.json'
+        # Commit image of older versions, migrated on first load
+        self.legacy_dir = f'{source_dir}/.{module_name}_commit_image.json'
+        self.retention = retention
+        self.snapshot_every = snapshot_every
+
+    def empty_commit(self):
+        """
+        The initial empty commit has id:0
+        """
+        return {'id': 0, 'commit_date': '', 'files_in_commit': [], 'hosts': [], 'log_entries': 0}
+
+    def head(self):
+        """
+        Returns the latest commit, migrating a legacy commit image if needed
+        """
+        try:
+            with open(self.head_dir) as f:
+                return json.load(f)
+        except:
+            pass
+        if os.path.exists(self.legacy_dir):
+            return self._migrate()
+        return self.empty_commit()
+
+    def history(self):
+        """
+        Yields every retained commit, oldest first, rebuilt from the log
+        """
+        files = []
+        try:
+            f = open(self.log_dir)
+        except OSError:
+            return
+        with f:
+            for line in f:
+                entry = json.loads(line)
+                if 'snapshot' in entry:
+                    files = entry.pop('snapshot')
+                else:
+                    removed = set(entry.pop('removed'))
+                    files = [file for file in files if file not in removed] + entry.pop('added')
+                entry['files_in_commit'] = files
+                yield entry
+
+    def append(self, files, hosts=[]):
+        """
+        Records a new commit and returns it
+        """
+        return self._append(self.head(), files, hosts)
+
+    def _append(self, head, files, hosts, commit_date=None, id=None):
+        id = int(head['id']) + 1 if id is None else int(id)
+        commit = {
+            'id': id,
+            'commit_date': datetime.now() if commit_date is None else commit_date,
+            'hosts': sorted(hosts),
+        }
+        log_entries = head['log_entries'] + 1
+
+        entry = dict(commit)
+        if log_entries == 1 or id % self.snapshot_every == 0:
+            entry['snapshot'] = list(files)
+        else:
+            previous = set(head['files_in_commit'])
+            current = set(files)
+            entry['removed'] = [file for file in head['files_in_commit'] if file not in current]
+            entry['added'] = [file for file in files if file not in previous]
+
+        os.makedirs(self.log_dir.rpartition('/')[0], exist_ok=True)
+        with open(self.log_dir, 'a') as fp:
+            fp.write(json.dumps(entry, default=str) + '\n')
+
+        # Compaction rewrites the log, so only do it once per snapshot_every commits
+        if log_entries > self.retention + self.snapshot_every:
+            log_entries = self._compact()
+
+        commit.update({'files_in_commit': list(files), 'log_entries': log_entries})
+        self._write_head(commit)
+        return commit
+
+    def _write_head(self, commit):
+        tmp_dir = f'{self.head_dir}.{os.getpid()}.tmp'
+        with open(tmp_dir, 'w') as fp:
+            json.dump(commit, fp, default=str)
+        os.replace(tmp_dir, self.head_dir)
+
+    def _compact(self):
+        """
+        Rewrites the log with only the last retention commits, the first one
+        as a snapshot. Returns the number of entries kept
+        """
+        commits = list(self.history())[-self.retention:]
+        tmp_dir = f'{self.log_dir}.{os.getpid()}.tmp'
+        with open(tmp_dir, 'w') as fp:
+            previous = None
+            for commit in commits:
+                files = commit.pop('files_in_commit')
+                entry = dict(commit)
+                if previous is None or int(commit['id']) % self.snapshot_every == 0:
+                    entry['snapshot'] = files
+                else:
+                    current = set(files)
+                    previous_set = set(previous)
+                    entry['removed'] = [file for file in previous if file not in current]
+                    entry['added'] = [file for file in files if file not in previous_set]
+                fp.write(json.dumps(entry, default=str) + '\n')
+                previous = files
+        os.replace(tmp_dir, self.log_dir)
+        return len(commits)
+
+    def _migrate(self):
+        """
+        Converts a legacy commit image (every commit with its full file list in
+        one JSON) to the log format and removes it. Returns the latest commit
+        """
+        try:
+            with open(self.legacy_dir) as f:
+                commits_image = json.load(f)
+        except:
+            return self.empty_commit()
+
+        commit = self.empty_commit()
+        for id, legacy in list(commits_image.items())[-self.retention:]:
+            commit = self._append(
+                commit, legacy['files_in_commit'], legacy.get('hosts', []), legacy['commit_date'], id
+            )
+        logger.info(f"Migrated {len(commits_image)} commits from {self.legacy_dir}")
+        os.remove(self.legacy_dir)
+        return commit
+
+
+class HostState:
+    """
+    Per host state store: every file of a module as last confirmed on a
+    host, mapped to [hash, size, mtime] of the remote copy
+    """
+
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+        self.files = None
+
+    def load(self):
+        """
+        Loads the host's manifest, files is None if the host has no state yet
+        """
+        try:
+            with open(self.state_dir) as f:
+                self.files = json.load(f)['files']
+        except:
+            self.files = None
+        return self
+
+    def save(self, files):
+        """
+        Atomically replaces the host's manifest
+        """
+        os.makedirs(self.state_dir.rpartition('/')[0], exist_ok=True)
+        tmp_dir = f'{self.state_dir}.{os.getpid()}.tmp'
+        with open(tmp_dir, 'w') as fp:
+            json.dump({'updated': datetime.now(), 'files': files}, fp, default=str)
+        os.replace(tmp_dir, self.state_dir)
+        self.files = files
+
+
+class ModuleSnapshot:
+    """
+    Read-only view of a local module: every file and its hash value.
+    Computed once per deploy and shared by the threads of every host
+    """
+
+    def __init__(self, source_dir, hashes):
+        self.source_dir = source_dir
+        self.hashes = MappingProxyType(dict(hashes))
+        self.files = tuple(self.hashes)
+
+    def version(self):
+        """
+        Returns a short digest identifying the content of the module
+        """
+        hash_md5 = hashlib.md5()
+        for fname in sorted(self.hashes):
+            hash_md5.update(f'{fname}\t{self.hashes[fname]}\n'.encode())
+        return hash_md5.hexdigest()[:12]
+
+
+class ModuleDiff:
+    """
+    Changes between a local module and a target:
+    new and updated files, moved and renamed files (dicts of source/target
+    path) and deleted files
+    """
+
+    def __init__(self, new=None, updated=None, moved=None, renamed=None, deleted=None):
+        self.new = new or []
+        self.updated = updated or []
+        self.moved = moved or []
+        self.renamed = renamed or []
+        self.deleted = deleted or []
+
+    def has_changes(self):
+        return any([self.new, self.updated, self.moved, self.renamed, self.deleted])
+
+    def as_dict(self):
+        return {
+            'new': self.new, 'updated': self.updated, 'moved': self.moved,
+            'renamed': self.renamed, 'deleted': self.deleted
+        }
+
+    @classmethod
+    def compare(cls, source_dict, target_dict):
+        """
+        Diffs two dicts of file and hash value in linear time.
+        Files missing on one side are paired with same-content files of the
+        other through a hash index, preferring the same basename (a move),
+        then the same directory (a rename), then the first path in sorted
+        order. Empty hashes (failed reads) are never paired
+        """
+        diff = cls()
+        source_not_found = []
+        target_left = dict(target_dict)
+
+        # Check for updated files
+        for source_file, source_hash in source_dict.items():
+            if source_file in target_left:
+                if source_hash != target_left.pop(source_file):
+                    diff.updated.append(source_file)
+            else:
+                source_not_found.append(source_file)
+
+        # Index what is left on target by hash, and by hash + basename/dir
+        by_hash, by_name, by_dir = {}, {}, {}
+        for target_file in sorted(target_left):
+            target_hash = target_left[target_file]
+            if not target_hash:
+                continue
+            target_subdir, _, target_name = target_file.rpartition("/")
+            by_hash.setdefault(target_hash, deque()).append(target_file)
+            by_name.setdefault((target_hash, target_name), deque()).append(target_file)
+            by_dir.setdefault((target_hash, target_subdir), deque()).append(target_file)
+
+        def take(index, key):
+            # Candidates are popped from the front, skipping already paired ones
+            candidates = index.get(key)
+            while candidates:
+                target_file = candidates.popleft()
+                if target_file in target_left:
+                    return target_file
+            return None
+
+        # Each pass pairs what it can, so same basename always wins over same dir
+        for pass_key in ('name', 'dir', 'hash'):
+            unmatched = []
+            for source_file in sorted(source_not_found):
+                source_hash = source_dict[source_file]
+                source_subdir, _, source_name = source_file.rpartition("/")
+                target_file = None
+                if source_hash:
+                    if pass_key == 'name':
+                        target_file = take(by_name, (source_hash, source_name))
+                    elif pass_key == 'dir':
+                        target_file = take(by_dir, (source_hash, source_subdir))
+                    else:
+                        target_file = take(by_hash, source_hash)
+                if target_file is None:
+                    unmatched.append(source_file)
+                    continue
+
+                target_left.pop(target_file)
+                change_dict = {"source": source_file, "target": target_file}
+                # if both source and target files have the
+                # same dir then its just a rename
+                if source_subdir == target_file.rpartition("/")[0]:
+                    diff.renamed.append(change_dict)
+                else:
+                    diff.moved.append(change_dict)
+            source_not_found = unmatched
+
+        # Whats left on source is considered new file, in source order
+        not_found = set(source_not_found)
+        diff.new = [file for file in source_dict if file in not_found]
+
+        # Whats left on target is considered deleted, as it no longer
+        # exists on source
+        diff.deleted = list(target_left)
+        return diff
+
+
 class VersionControl:
     """
     Responsible for finding file changes between local and deployed module
     """
 
-    def __init__(self, sftp, source_dir, verbose):
+    def __init__(self, sftp, source_dir, verbose, remote_hash=True, snapshot=None, last_commit=None,
+                 hostname=None, concurrency=4, delta_threshold=256 * 1024,
+                 bulk_files=32, bulk_bytes=8 * 1024 * 1024, verify='trust', commit_retention=500):
         self.sftp = sftp
         self.source_dir = source_dir
-        self.target_dir = self.sftp.getcwd()
+        # sftp may be None when only the local module is inspected
+        self.target_dir = self.sftp.getcwd() if sftp is not None else None
         self.module_name = self.source_dir.rpartition('/')[-1]
         self.verbose = verbose
+        self.remote_hash = remote_hash
+        # Local module snapshot and parsed commit image, either shared by the
+        # caller across hosts or loaded lazily by this instance
+        self.snapshot = snapshot
+        self.hostname = hostname
+        self.concurrency = max(1, concurrency)
+        # Updated files of at least this size are sent as a block delta,
+        # None disables delta transfers
+        self.delta_threshold = delta_threshold
+        # New files are streamed as a single tar when there are at least
+        # bulk_files of them or they add up to bulk_bytes
+        self.bulk_files = bulk_files
+        self.bulk_bytes = bulk_bytes
+        # How the host's recorded state is checked against the target:
+        # 'trust' uses it as is, 'stat' re-hashes files whose size or mtime
+        # changed and 'full' re-hashes every file
+        self.verify = verify
         self.should_rebuild = False
-        self.commit_image_json_dir = self._commit_json_dir()
-        self.commits_image = {}
+        self.commit_store = CommitStore(self.source_dir, self.module_name, retention=commit_retention)
+        self.hash_cache_dir = self._hash_cache_dir()
+        self.host_state_dir = f'{self.source_dir}/.{self.module_name}_hosts'
+        self.ignore = [
+            self.commit_store.log_dir, self.commit_store.head_dir, self.commit_store.legacy_dir,
+            self.hash_cache_dir, self.host_state_dir
+        ]
+        self.host_state = None
+        if sftp is not None and hostname is not None:
+            self.host_state = HostState(f'{self.host_state_dir}/{hostname}.json').load()
+        self.FAILED = []
+        self.state_stale = False
+        self.last_commit = last_commit
         self.NEW = []
         self.UPDATED = []
         self.MOVED = []
         self.RENAMED = []
         self.DELETED = []
 
-    def _commit_json_dir(self):
+    def _hash_cache_dir(self):
         '''
-        Returns the directory of the commit_image.json for given module
+        Returns the directory of the local hash cache for given module
         '''
-        # folder will be assigned using a config file later on
-        # Currently we will just with the module folder
-        commit_image_dir = self.source_dir
-        module = self.module_name
-        commit_image_json_dir = f'{commit_image_dir}/.{module}_commit_image.json'
-        return commit_image_json_dir
+        return f'{self.source_dir}/.{self.module_name}_hash_cache.json'
+
+    def scan(self):
+        """
+        Returns a ModuleSnapshot of every local file of the module and its
+        hash value. Unchanged files are served from the persistent hash cache
+        """
+        files = self._get_files(self.source_dir, ignore=self.ignore)
+        cache = HashCache(self.hash_cache_dir).load()
+        hash_dict = cache.checksum(files, self.source_dir, self._hash_file)
+        cache.save()
+        return ModuleSnapshot(self.source_dir, hash_dict)
 
     def _hash_file(self, fname, remote=False):
         """
@@ -132,6 +907,120 @@ class VersionControl:
 
         return hash_md5.hexdigest()
 
+    def _remote_python(self, script, args=[], data=b'', directory=None):
+        """
+        Runs a python script on the target, in directory (target_dir by
+        default), with a single exec_command. Returns the exit status and
+        stdout, with status 127 if the target has no usable interpreter
+        """
+        directory = self.target_dir if directory is None else directory
+        script = " ".join(shlex.quote(str(arg)) for arg in [script] + list(args))
+        command = (
+            f"cd {shlex.quote(directory)} && "
+            f"for py in python3 python; do "
+            f"command -v $py >/dev/null 2>&1 && exec $py -c {script}; "
+            f"done; exit 127"
+        )
+        transport = self.sftp.get_channel().get_transport()
+        channel = transport.open_session()
+        try:
+            channel.exec_command(command)
+            channel.sendall(data)
+            channel.shutdown_write()
+            output = channel.makefile('rb').read()
+            status = channel.recv_exit_status()
+        finally:
+            channel.close()
+        return status, output
+
+    def _remote_manifest(self, directory, files):
+        """
+        Hashes the given files on the target with a single exec_command.
+        Returns a dict of file and hash value, or None if the target has no
+        usable python interpreter (caller should fall back to SFTP hashing)
+        """
+        try:
+            status, output = self._remote_python(
+                REMOTE_HASH_SCRIPT, data=b'\0'.join(f.encode() for f in files), directory=directory
+            )
+        except Exception as e:
+            logger.debug(f"Remote hashing failed: {e}")
+            return None
+
+        if status != 0:
+            logger.debug(f"Remote hashing exited with status {status}")
+            return None
+
+        return self._parse_records(output)
+
+    def _remote_stat(self, files):
+        """
+        Returns a dict of file and [size, mtime] on the target (None for
+        missing files) with a single exec_command, or None if not possible
+        """
+        try:
+            status, output = self._remote_python(
+                REMOTE_STAT_SCRIPT, data=b'\0'.join(f.encode() for f in files)
+            )
+        except Exception as e:
+            logger.debug(f"Remote stat failed: {e}")
+            return None
+
+        if status != 0:
+            logger.debug(f"Remote stat exited with status {status}")
+            return None
+
+        stats = {}
+        for fname, record in self._parse_records(output).items():
+            size, _, mtime = record.partition(' ')
+            stats[fname] = [int(size), mtime] if record else None
+        return stats
+
+    def _parse_records(self, output):
+        """
+        Parses the NUL-terminated "<value>\\t<name>" records printed by the
+        remote scripts into a dict of name and value
+        """
+        records = {}
+        for record in output.split(b'\0'):
+            if not record:
+                continue
+            value, _, fname = record.decode(errors='surrogateescape').partition('\t')
+            records[fname] = value
+        return records
+
+    def _put_delta(self, file):
+        """
+        Updates a file on the target by sending only the blocks that changed.
+        Returns the number of bytes sent, or None if a full put is needed
+        (no interpreter on the target, delta not smaller than the file or
+        reconstruction failed, in which case the target file is untouched)
+        """
+        try:
+            status, output = self._remote_python(delta.SIGNATURE_SCRIPT, [file])
+            if status != 0:
+                return None
+            block_size, signatures = delta.parse_signatures(output)
+
+            with open(f"{self.source_dir}/{file}", "rb") as f:
+                data = f.read()
+            patch = delta.compute_delta(data, block_size, signatures)
+            if len(patch) + len(output) >= len(data):
+                return None
+
+            status, _ = self._remote_python(
+                delta.PATCH_SCRIPT, [file, hashlib.md5(data).hexdigest(), block_size], data=patch
+            )
+        except Exception as e:
+            logger.debug(f"Delta transfer of {file} failed: {e}")
+            return None
+
+        if status != 0:
+            logger.debug(f"Delta transfer of {file} exited with status {status}")
+            return None
+        logger.debug(f"Delta transfer of {file}: sent {len(patch)} of {len(data)} bytes")
+        return len(patch) + len(output)
+
     def _listdir(self, dir, remote):
         listdir = self.sftp.listdir_attr(dir) if remote else os.listdir(dir)
         return listdir
@@ -168,32 +1057,104 @@ class VersionControl:
                             files.append(file_path)
         return files
     
-    def _folder_checksum(self, directory, ignore=[], remote=False):
+    def _folder_checksum(self, directory, ignore=[], remote=False, remote_files=None):
         """
-        Returns a dictionary with every file and its hash value
+        Returns a dictionary with every file and its hash value. Remote files
+        that are missing or cannot be read are left out, so that they are
+        uploaded as new files
         """
         hash_dict = {}
         try:
             files = []
-            last_commit = list(self.commits_image.values())[-1]
-            last_commit_files = last_commit['files_in_commit']
-            # In remote we will only check for files contained in last commit
+            # In remote we will only check for files known to be on the host
+            # (or contained in last commit), hashing them on the target when possible
+            if remote and remote_files is None:
+                remote_files = self._remote_files()
+            if remote and self.remote_hash:
+                manifest = self._remote_manifest(directory, remote_files)
+                if manifest is not None:
+                    return {fname: file_hash for fname, file_hash in manifest.items() if file_hash}
+                logger.debug("Falling back to hashing remote files over SFTP")
             if remote:
-                for file in last_commit_files:
+                for file in remote_files:
                     full_dir = f"{directory}/{file}"
                     files.append(full_dir)
-            # If locally, we will check every file contained in module
+            # If locally, we will check every file contained in module,
+            # reusing the snapshot computed once for the whole deploy if given
             else:
-                files = self._get_files(directory, ignore=ignore, remote=remote)
+                if self.snapshot is None:
+                    self.snapshot = self.scan()
+                return dict(self.snapshot.hashes)
 
             for file in files:
                 file_hash = self._hash_file(file, remote)
-                fname = self._strip_dir(file, directory)
-                hash_dict.update({fname: file_hash})
+                if file_hash:
+                    hash_dict.update({self._strip_dir(file, directory): file_hash})
         except Exception as e:
             raise e
         return hash_dict
 
+    def _remote_files(self):
+        """
+        Returns the files expected on the target: the host's recorded state
+        if there is one, otherwise the files of the last commit
+        """
+        if self.host_state is not None and self.host_state.files is not None:
+            return list(self.host_state.files)
+        return self.last_commit['files_in_commit']
+
+    def _target_checksum(self):
+        """
+        Returns a dictionary with every file on the target and its hash value,
+        based on the host's recorded state and the verify mode
+        """
+        state = self.host_state.files if self.host_state is not None else None
+        if state is None or self.verify == 'full':
+            return self._folder_checksum(self.target_dir, ignore=self.ignore, remote=True)
+
+        target_dict = {fname: entry[0] for fname, entry in state.items()}
+        if self.verify == 'stat':
+            stats = self._remote_stat(list(state))
+            if stats is None:
+                return self._folder_checksum(self.target_dir, ignore=self.ignore, remote=True)
+            # Only files whose size or mtime changed since recorded are re-hashed
+            stale = [fname for fname, entry in state.items() if stats.get(fname) != entry[1:]]
+            if stale:
+                logger.debug(f"Re-hashing {len(stale)} files changed on target")
+                # Stale files missing on the target are not in the re-hashed dict
+                for fname in stale:
+                    del target_dict[fname]
+                target_dict.update(self._folder_checksum(
+                    self.target_dir, ignore=self.ignore, remote=True, remote_files=stale
+                ))
+                self.state_stale = True
+        return target_dict
+
+    def _update_host_state(self):
+        """
+        Records the files now on the target with their hash, size and mtime
+        """
+        files = [fname for fname in self.snapshot.files if fname not in self.FAILED]
+        stats = self._remote_stat(files) or {}
+        state = {}
+        for fname in files:
+            stat = stats.get(fname) or [None, None]
+            state[fname] = [self.snapshot.hashes[fname]] + stat
+        try:
+            self.host_state.save(state)
+        except OSError as e:
+            logger.debug(f"Could not write host state {self.host_state.state_dir}: {e}")
+
+    def _write_version(self):
+        """
+        Records the version of the module now on the target, read by emp check
+        """
+        try:
+            with self.sftp.open(f'{self.target_dir}/{VERSION_FILE}', 'w') as f:
+                f.write(f'{self.snapshot.version()} {int(time.time())}\n')
+        except IOError as e:
+            logger.debug(f"Could not write {VERSION_FILE}: {e}")
+
     def _print_changes(self):
         """
         Prints the changes found in the source versus the target module
@@ -221,19 +1182,123 @@ class VersionControl:
         else:
             logger.info("No changes detected")
 
-    def _mkdir(self, dir):
+    def _mkdirs(self, dirs):
         '''
-        Creates folders of a directory remotely recursively
+        Creates every given folder (and its parents) remotely, trying each
+        path component only once
         '''
-        subfolders = dir.split("/")
-        current_dir = ""
-        for folder in subfolders:
-            current_dir = f"{current_dir}/{folder}".strip("/")
+        all_dirs = set()
+        for dir in dirs:
+            current_dir = ""
+            for folder in dir.split("/"):
+                current_dir = f"{current_dir}/{folder}".strip("/")
+                if current_dir:
+                    all_dirs.add(current_dir)
+
+        # Parents are created before their children
+        for dir in sorted(all_dirs, key=lambda d: (d.count("/"), d)):
             try:
-                self.sftp.mkdir(current_dir)
+                self.sftp.mkdir(dir)
             except IOError:
                 pass
 
+    def _open_channels(self, count):
+        '''
+        Opens up to count extra SFTP channels on the transport of self.sftp
+        '''
+        channels = []
+        transport = self.sftp.get_channel().get_transport()
+        for _ in range(count):
+            try:
+                channels.append(type(self.sftp).from_transport(transport))
+            except Exception as e:
+                # The server may limit sessions per connection (MaxSessions)
+                logger.debug(f"Could not open extra SFTP channel: {e}")
+                break
+        return channels
+
+    def _put_files(self, files, delta_files=[]):
+        """
+        Uploads the given files concurrently over several SFTP channels of the
+        same transport. Files in delta_files are first tried as a block delta.
+        Returns the number of bytes transferred
+        """
+        source_dir = self.source_dir
+        target_dir = self.target_dir
+        extra = self._open_channels(min(self.concurrency, len(files)) - 1) if len(files) > 1 else []
+        channels = queue.Queue()
+        for channel in [self.sftp] + extra:
+            channels.put(channel)
+
+        def put(file):
+            sftp = channels.get()
+            try:
+                if file in delta_files:
+                    sent = self._put_delta(file)
+                    if sent is not None:
+                        return sent
+                # put() pipelines its writes, so each channel keeps several
+                # requests in flight instead of waiting for every ack
+                attrs = sftp.put(f"{source_dir}/{file}", f"{target_dir}/{file}")
+                return attrs.st_size or 0
+            except IOError as e:
+                logger.debug(f"Could not upload {file}: {e}")
+                self.FAILED.append(file)
+                return 0
+            finally:
+                channels.put(sftp)
+
+        try:
+            with ThreadPoolExecutor(max_workers=channels.qsize()) as executor:
+                transferred = sum(executor.map(put, files))
+        finally:
+            for channel in extra:
+                channel.close()
+        return transferred
+
+    def _put_tar(self, files):
+        """
+        Uploads the given files as one gzip compressed tar stream extracted by
+        tar on the target. Returns the number of bytes sent, or None if the
+        target could not extract it (caller should fall back to per file puts)
+        """
+        class CountingWriter:
+            def __init__(self, fp):
+                self.fp = fp
+                self.count = 0
+
+            def write(self, data):
+                self.fp.write(data)
+                self.count += len(data)
+
+        def strip_owner(tarinfo):
+            tarinfo.uid = tarinfo.gid = 0
+            tarinfo.uname = tarinfo.gname = ""
+            return tarinfo
+
+        target_dir = shlex.quote(self.target_dir)
+        transport = self.sftp.get_channel().get_transport()
+        channel = transport.open_session()
+        try:
+            channel.exec_command(f"mkdir -p {target_dir} && tar -xzf - -C {target_dir}")
+            writer = CountingWriter(channel.makefile('wb'))
+            with tarfile.open(fileobj=writer, mode='w|gz') as tar:
+                for file in files:
+                    tar.add(f"{self.source_dir}/{file}", arcname=file, filter=strip_owner)
+            channel.shutdown_write()
+            stderr = channel.makefile_stderr('rb').read()
+            status = channel.recv_exit_status()
+        except Exception as e:
+            logger.debug(f"Bulk upload failed: {e}")
+            return None
+        finally:
+            channel.close()
+
+        if status != 0:
+            logger.debug(f"Bulk upload exited with status {status}: {stderr.decode(errors='replace')}")
+            return None
+        return writer.count
+
     def _strip_dir(self, input, strip_on):
         """
         Strips file(s) directory
@@ -246,71 +1311,42 @@ class VersionControl:
             input = input.split(strip_on)[-1].strip("/")
         return input
 
-    def _parse_commit_image(self):
+    def transfer_estimate(self, hostname):
         """
-        Checks if a commit_image.json exists locally and save it's contents in self.commits_image
+        Returns the number of bytes a deploy of the scanned module is
+        expected to upload to a host, from the host's recorded state
         """
-        commits_image_json_dir = self.commit_image_json_dir
-        try:
-            f = open(commits_image_json_dir)
-            commits_image = json.load(f)
-            self.commits_image = commits_image
-        except:
-            # The initial empty commit has key:0
-            self.commits_image = {0: {
-                'commit_date': '',
-                'files_in_commit': []
-                }
-            }
-
-    def _update_commit_image(self):
-        """
-        Updates the commit_image with the current commit
-        """
-        base_dir = self.source_dir
-        commit_image_json_dir = self.commit_image_json_dir
-        commit_image_filename = commit_image_json_dir.rpartition('/')[-1]
-
-        # Get latest id from json file, if it exists, could use max() too
-        id = 1
-        commits_image = self.commits_image
-        if commits_image:
-            id = list(commits_image.keys())[-1]
-            id = int(id) + 1
-
-        # Get files of current commit
-        current_commit = self._get_files(base_dir)
-        current_commit = self._strip_dir(current_commit, base_dir)
-
-        # Remove .image_file from current commit if it exists
-        if commit_image_filename in current_commit:
-            image_file_index = current_commit.index(commit_image_filename)
-            current_commit.pop(image_file_index)
-
-        # Format commit for json
-        _datetime = datetime.now()
-        commits_image.update({
-            id: {
-                'commit_date': _datetime,
-                'files_in_commit': current_commit
-             }}
+        state = HostState(f'{self.host_state_dir}/{hostname}.json').load().files or {}
+        return sum(
+            os.path.getsize(f'{self.source_dir}/{fname}')
+            for fname, file_hash in self.snapshot.hashes.items()
+            if fname not in state or state[fname][0] != file_hash
         )
 
-        # Create parent directory of commit_image if it doesn't exist
-        commit_image_parent = commit_image_json_dir.rpartition('/')[0]
-        try:
-            os.makedirs(commit_image_parent, exist_ok=True)
-        except Exception as e: raise e
+    def load_commit_image(self):
+        """
+        Loads the latest commit of the module in self.last_commit
+        """
+        self.last_commit = self.commit_store.head()
+        return self.last_commit
 
-        # Update json
-        # Commit with key:0 is the initial empty commit. Remove if it exists
-        with open(commit_image_json_dir, 'w') as fp:
-            commits_image.pop(0, None)
-            json.dump(commits_image, fp, indent=4, default=str)
+    def update_commit_image(self, hosts=[]):
+        """
+        Records the current snapshot as a new commit deployed on hosts
+        """
+        if self.snapshot is None:
+            self.snapshot = self.scan()
+        self.last_commit = self.commit_store.append(self.snapshot.files, hosts)
+
+    def has_changes(self):
+        """
+        Returns whether compare_modules found any difference on the target
+        """
+        return any([self.NEW, self.UPDATED, self.MOVED, self.RENAMED, self.DELETED])
 
     def compare_modules(self):
         """
-        Returns  lists: updated, moved, deleted
+        Returns a ModuleDiff and sets lists: new, updated, moved, renamed, deleted
         New are the files that are introduced by the source for the first time
         Updated are the files that exist in both dirs but have been altered
         Moved are the files that exists in both dirs, haven't been altered,
@@ -320,94 +1356,78 @@ class VersionControl:
         in the source
         """
         verbose = self.verbose
-        commit_image_json_dir = self.commit_image_json_dir
-        
+
         if verbose:
             logger.debug("Checking for changes in module..")
 
-        # Parse last commit image
-        self._parse_commit_image()
+        # Load last commit, unless shared by the caller
+        if self.last_commit is None:
+            self.load_commit_image()
 
         # Get hash value of each file in given folder
-        source_not_found = {}
         source_dict = self._folder_checksum(
-            self.source_dir, ignore=[commit_image_json_dir], remote=False
+            self.source_dir, ignore=self.ignore, remote=False
             )
-        target_dict = self._folder_checksum(
-            self.target_dir, ignore=[commit_image_json_dir], remote=True
-            )
-
-        # Check for updated files
-        for source_file in source_dict.keys():
-            try:
-                source_hash = source_dict[source_file]
-                target_hash = target_dict[source_file]
-                if source_hash != target_hash:
-                    self.UPDATED.append(source_file)
-                target_dict.pop(source_file)
-            except KeyError:
-                source_not_found.update({source_file: source_hash})
-
-        # Check for renamed or moved files
-        for source_file in source_not_found.keys():
-            for target_file in target_dict.keys():
-                if source_dict[source_file] == target_dict[target_file]:
-                    change_dict = {"source": source_file, "target": target_file}
-                    source_subdir = source_file.rpartition("/")[0]
-                    target_subdir = target_file.rpartition("/")[0]
-                    # if both source and target files have the
-                    # same dir then its just a rename
-                    if source_subdir == target_subdir:
-                        self.RENAMED.append(change_dict)
-                    else:
-                        self.MOVED.append(change_dict)
-                    break
+        target_dict = self._target_checksum()
 
-        # Remove renamed/moved files from dictionaries
-        for file in self.MOVED + self.RENAMED:
-            source_not_found.pop(file["source"])
-            target_dict.pop(file["target"])
-
-        # Whats left on source is considered new file
-        self.NEW = list(source_not_found.keys())
-        
-        # Whats left on target is considered deleted, as it no longer
-        # exists on source
-        self.DELETED = list(target_dict.keys())
+        self.diff = ModuleDiff.compare(source_dict, target_dict)
+        self.NEW = self.diff.new
+        self.UPDATED = self.diff.updated
+        self.MOVED = self.diff.moved
+        self.RENAMED = self.diff.renamed
+        self.DELETED = self.diff.deleted
         self._print_changes()
+        return self.diff
 
     def update_target(self, requirements="requirements.txt"):
         """
         Uploads target module based on the changes found
         """
         verbose = self.verbose
-        source_dir = self.source_dir
         target_dir = self.target_dir
 
         # Set new and updated files
         new_updated = self.NEW + self.UPDATED
         self.should_rebuild = requirements in new_updated
 
-        for file in new_updated:
-            source_dir_file = f"{source_dir}/{file}"
-            target_dir_file = f"{target_dir}/{file}"
+        start = time.perf_counter()
+        transferred = 0
 
-            # Create recursively file's directory if it doesn't exist
-            new_dir = file.rpartition("/")[0]
-            self._mkdir(new_dir)
-            try:
-                self.sftp.put(source_dir_file, target_dir_file)
-            except IOError:
-                pass
+        # Many or large new files (e.g. a first deploy) are sent as one tar
+        new_bytes = sum(os.path.getsize(f"{self.source_dir}/{file}") for file in self.NEW)
+        if self.NEW and (len(self.NEW) >= self.bulk_files or new_bytes >= self.bulk_bytes):
+            sent = self._put_tar(self.NEW)
+            if sent is not None:
+                transferred += sent
+                new_updated = self.UPDATED[:]
+
+        # Create every directory needed by the remaining files in one pass
+        self._mkdirs(
+            [file.rpartition("/")[0] for file in new_updated]
+            + [file["source"].rpartition("/")[0] for file in self.MOVED]
+        )
+
+        if new_updated:
+            # Large updated files are sent as a delta against the target's copy
+            delta_files = set(
+                file for file in self.UPDATED
+                if self.delta_threshold is not None
+                and os.path.getsize(f"{self.source_dir}/{file}") >= self.delta_threshold
+            )
+            transferred += self._put_files(new_updated, delta_files)
+
+        if self.NEW or self.UPDATED:
+            elapsed = time.perf_counter() - start
+            scribe(
+                f"Uploaded {len(self.NEW) + len(self.UPDATED)} files ({transferred / 1024:.1f} KB) "
+                f"in {elapsed:.2f}s, {transferred / 1024 / max(elapsed, 1e-6):.1f} KB/s",
+                hostname=self.hostname
+            )
 
         # Move files
         for file in self.MOVED:
             target_dir_new = "{}/{}".format(target_dir, file["source"])
             target_dir_old = "{}/{}".format(target_dir, file["target"])
-
-            # Create recursively file's directory if it doesn't exist(remotely)
-            new_dir = file["source"].rpartition("/")[0]
-            self._mkdir(new_dir)
             try:
                 self.sftp.rename(target_dir_old, target_dir_new)
             except IOError:
@@ -422,7 +1442,11 @@ class VersionControl:
         # Make deletions
         for file in self.DELETED:
             target_dir_file = f"{target_dir}/{file}"
-            self.sftp.remove(target_dir_file)
+            # Already missing on the target (e.g. removed by hand) is deleted too
+            try:
+                self.sftp.remove(target_dir_file)
+            except IOError:
+                pass
 
         # Delete empty directories
         may_be_empty = []
@@ -442,8 +1466,15 @@ class VersionControl:
                 # Check if parent folder is now empty
                 unique_dirs.append(parent_dir)
 
-        if any([self.NEW, self.UPDATED, self.MOVED, self.RENAMED, self.DELETED]):
-            self._update_commit_image()
+        # Remember what the host now has, so the next deploy can skip hashing it
+        if self.host_state is not None and (
+            self.has_changes() or self.state_stale or self.host_state.files is None
+        ):
+            self._update_host_state()
+        if not self.FAILED and (
+            self.has_changes() or self.state_stale or self.host_state is None or self.host_state.files is None
+        ):
+            self._write_version()
 
         if verbose:
             self._print_changes()
\ No newline at end of file